@@ -0,0 +1,40 @@
+"""unique users guild_id user_id
+
+Revision ID: 3c1d7e9a4b52
+Revises: f55be95078ca
+Create Date: 2026-10-18 10:12:40.318204
+
+"""
+
+from alembic import op
+
+revision = "3c1d7e9a4b52"
+down_revision = "f55be95078ca"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Concurrent select-then-insert could create the same user twice; keep
+    # the row with the most bets (the oldest on a tie) before adding the
+    # unique index.
+    op.execute(
+        """
+        DELETE FROM users WHERE id NOT IN (
+            SELECT id FROM (
+                SELECT id, ROW_NUMBER() OVER (
+                    PARTITION BY guild_id, user_id ORDER BY num_bets DESC, id ASC
+                ) AS rank
+                FROM users
+            ) AS ranked
+            WHERE rank = 1
+        )
+    """
+    )
+    op.create_index(
+        "ix_users_guild_id_user_id", "users", ["guild_id", "user_id"], unique=True
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_users_guild_id_user_id", table_name="users")
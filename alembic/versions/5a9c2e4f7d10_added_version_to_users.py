@@ -0,0 +1,28 @@
+"""added version to users
+
+Revision ID: 5a9c2e4f7d10
+Revises: 8e2f0b6d1a37
+Create Date: 2026-10-18 11:48:03.190522
+
+"""
+
+import sqlalchemy as sa
+
+from alembic import op
+
+revision = "5a9c2e4f7d10"
+down_revision = "8e2f0b6d1a37"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table("users", schema=None) as batch_op:
+        batch_op.add_column(
+            sa.Column("version", sa.Integer(), nullable=False, server_default="0")
+        )
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("users", schema=None) as batch_op:
+        batch_op.drop_column("version")
@@ -0,0 +1,26 @@
+"""users leaderboard index
+
+Revision ID: 8e2f0b6d1a37
+Revises: 3c1d7e9a4b52
+Create Date: 2026-10-18 11:02:15.774630
+
+"""
+
+from alembic import op
+
+revision = "8e2f0b6d1a37"
+down_revision = "3c1d7e9a4b52"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        "ix_users_guild_id_is_present_iq",
+        "users",
+        ["guild_id", "is_present", "iq"],
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_users_guild_id_is_present_iq", table_name="users")
@@ -0,0 +1,28 @@
+"""bets expiry
+
+Revision ID: b7d41f3e2c95
+Revises: 5a9c2e4f7d10
+Create Date: 2026-10-18 13:21:47.905117
+
+"""
+
+import sqlalchemy as sa
+
+from alembic import op
+
+revision = "b7d41f3e2c95"
+down_revision = "5a9c2e4f7d10"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table("bets", schema=None) as batch_op:
+        batch_op.add_column(sa.Column("channel_id", sa.BigInteger(), nullable=True))
+        batch_op.create_index("ix_bets_timestamp", ["timestamp"])
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("bets", schema=None) as batch_op:
+        batch_op.drop_index("ix_bets_timestamp")
+        batch_op.drop_column("channel_id")
@@ -0,0 +1,272 @@
+"""Offline benchmark for context assembly and prompt building.
+
+Drives gpt.format_message, gpt.count_tokens, gpt.read_context and
+gpt.build_prompt with synthetic channels of fake messages (some replies,
+some from bots) and appends the results, tagged with the current commit, to
+a JSON lines file so runs can be compared across commits:
+
+    python scripts/bench_context.py --sizes 100 1000 10000 100000
+    python scripts/bench_context.py --compare
+
+No network access is needed once tiktoken's encoding is in its cache
+(TIKTOKEN_CACHE_DIR); pass --approx-tokens to count whitespace-separated
+words instead.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Awaitable, Callable
+
+os.environ.setdefault("TOKENS", '{"bot": "offline", "gpt": "offline"}')
+
+from discord import Message, MessageReference, utils
+from loguru import logger
+
+from iqbot import tokens
+from iqbot.config import settings
+from iqbot.history import ChannelBuffer
+
+WORDS = (
+    "the argument premise therefore however evidence because claim source "
+    "logic fallacy consistent wrong right actually obviously study data"
+).split()
+
+
+class FakeMessage(Message):
+    def __init__(self, id: int, author, content: str, channel, reference=None):
+        self.id = id
+        self.author = author
+        self.content = content
+        self.channel = channel
+        self.guild = None
+        self.reference = reference
+        self.attachments = []
+        self.embeds = []
+        self._edited_timestamp = None
+
+
+class FakeChannel:
+    def __init__(self, id: int, messages: list[FakeMessage]):
+        self.id = id
+        self.messages = messages
+
+    async def history(self, limit=100, before=None, after=None, oldest_first=None):
+        # Like py-cord: with `after` and no `oldest_first`, it pages forward
+        # from `after`, and `limit` keeps the oldest messages of the range.
+        if oldest_first is None:
+            oldest_first = after is not None
+        before = before.astimezone(timezone.utc) if before else None
+        after = after.astimezone(timezone.utc) if after else None
+        selected = [
+            m
+            for m in self.messages
+            if (after is None or m.created_at > after)
+            and (before is None or m.created_at < before)
+        ]
+        if not oldest_first:
+            selected.reverse()
+        for message in selected[:limit] if limit else selected:
+            yield message
+
+
+class WordEncoding:
+    def encode(self, text: str, **kwargs) -> list[str]:
+        return text.split()
+
+
+def make_channel(size: int, seed: int) -> FakeChannel:
+    rng = random.Random(seed)
+    authors = [
+        SimpleNamespace(id=1000 + i, name=f"user{i}", bot=i == 0) for i in range(12)
+    ]
+    channel = FakeChannel(id=seed, messages=[])
+    start = datetime.now(timezone.utc) - timedelta(seconds=size)
+    for i in range(size):
+        message_id = utils.time_snowflake(start + timedelta(seconds=i)) + i % 4096
+        reference = None
+        if channel.messages and rng.random() < 0.3:
+            resolved = rng.choice(channel.messages[-50:])
+            reference = MessageReference(message_id=resolved.id, channel_id=channel.id)
+            reference.resolved = resolved
+        content = " ".join(rng.choices(WORDS, k=rng.randint(3, 60)))
+        author = authors[0] if rng.random() < 0.1 else rng.choice(authors[1:])
+        channel.messages.append(
+            FakeMessage(message_id, author, content, channel, reference)
+        )
+    return channel
+
+
+def summarize(name: str, size: int, latencies: list[float], items: int, peak: int):
+    latencies = sorted(latencies)
+    quantiles = (
+        statistics.quantiles(latencies, n=100, method="inclusive")
+        if len(latencies) > 1
+        else []
+    )
+    return {
+        "name": name,
+        "size": size,
+        "runs": len(latencies),
+        "throughput": items * len(latencies) / sum(latencies) if sum(latencies) else 0,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": (quantiles[94] if quantiles else latencies[0]) * 1000,
+        "p99_ms": (quantiles[98] if quantiles else latencies[0]) * 1000,
+        "peak_kib": peak / 1024,
+    }
+
+
+async def measure(
+    name: str, size: int, items: int, runs: int, func: Callable[[], Awaitable[Any]]
+) -> dict:
+    latencies = []
+    tracemalloc.start()
+    for _ in range(runs):
+        start = time.perf_counter()
+        await func()
+        latencies.append(time.perf_counter() - start)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return summarize(name, size, latencies, items, peak)
+
+
+async def bench_size(size: int, runs: int) -> list[dict]:
+    from iqbot import gpt
+
+    settings.gpt.history.messages = size
+    settings.gpt.history.minutes = size // 60 + 2
+    channel = make_channel(size, seed=size)
+    messages = channel.messages
+    ctx = messages[-1]
+    sample = messages[-min(size, 1000) :]
+    conversation = await gpt.read_context(ctx)
+
+    async def format_messages():
+        for message in sample:
+            gpt.format_message(message)
+
+    async def count_tokens():
+        for message in sample:
+            gpt.count_tokens(message.content)
+
+    async def read_rest():
+        gpt.counter.message_counts.clear()
+        await gpt.read_context(ctx)
+
+    buffer = ChannelBuffer(channel.id, size, 1 << 40)
+
+    async def read_buffered():
+        gpt.buffers.buffers[channel.id] = buffer
+        try:
+            await gpt.read_context(ctx)
+        finally:
+            del gpt.buffers.buffers[channel.id]
+
+    async def build_prompt():
+        await gpt.build_prompt(
+            conversation, settings.gpt.system_prompt, "Who won, user1 or user2?"
+        )
+
+    results = [
+        await measure("format_message", size, len(sample), runs, format_messages),
+        await measure("count_tokens", size, len(sample), runs, count_tokens),
+        await measure("read_context_rest", size, size, runs, read_rest),
+    ]
+    await read_buffered()  # cold start backfills the buffer
+    results.append(
+        await measure("read_context_buffered", size, size, runs, read_buffered)
+    )
+    results.append(await measure("build_prompt", size, 1, runs, build_prompt))
+    return results
+
+
+def current_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(path: Path) -> None:
+    runs = [json.loads(line) for line in path.read_text().splitlines() if line]
+    if len(runs) < 2:
+        print("Need at least two stored runs to compare.")
+        return
+    old, new = runs[-2], runs[-1]
+    baseline = {(r["name"], r["size"]): r for r in old["results"]}
+    print(f"{old['commit']} -> {new['commit']}")
+    for result in new["results"]:
+        before = baseline.get((result["name"], result["size"]))
+        if before is None or not before["p50_ms"]:
+            continue
+        change = result["p50_ms"] / before["p50_ms"] - 1
+        print(
+            f"{result['name']:>22} {result['size']:>7}: "
+            f"p50 {before['p50_ms']:9.3f} -> {result['p50_ms']:9.3f} ms ({change:+.1%})"
+        )
+
+
+async def async_main(args: argparse.Namespace) -> None:
+    if args.approx_tokens:
+        # gpt resolves its tokenizer on import, so swap it in beforehand.
+        tokens.get_encoding = lambda model: WordEncoding()  # type: ignore
+    from iqbot import gpt
+
+    # Only bench-local buffers should be used, never the whitelisted channels.
+    gpt.buffers.buffers.clear()
+    if not args.verbose:
+        logger.remove()
+
+    results = []
+    for size in args.sizes:
+        for result in await bench_size(size, args.runs):
+            results.append(result)
+            print(
+                f"{result['name']:>22} {size:>7}: p50 {result['p50_ms']:9.3f} ms  "
+                f"p95 {result['p95_ms']:9.3f} ms  p99 {result['p99_ms']:9.3f} ms  "
+                f"{result['throughput']:12.0f}/s  peak {result['peak_kib']:9.1f} KiB"
+            )
+
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with args.output.open("a") as f:
+        record = {
+            "commit": current_commit(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "approx_tokens": args.approx_tokens,
+            "results": results,
+        }
+        f.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000]
+    )
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--output", type=Path, default=Path("benchmarks/context.jsonl"))
+    parser.add_argument("--approx-tokens", action="store_true")
+    parser.add_argument("--compare", action="store_true")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.output)
+    else:
+        asyncio.run(async_main(args))
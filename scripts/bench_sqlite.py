@@ -0,0 +1,135 @@
+"""Read/write concurrency benchmark for the SQLite engine profile.
+
+Seeds a throwaway database with users, then runs concurrent readers
+(`db.read_user`, with the user cache off so every read reaches SQLite)
+against concurrent bet settlements (`db.settle_bet`) for a fixed time,
+once with the engine the bot used to create (rollback journal, default
+pragmas, a 10 + 20 connection pool) and once with `db.create_engine` and
+the `[database.sqlite]` profile:
+
+    python scripts/bench_sqlite.py --users 500 --readers 16 --writers 4 \\
+        --duration 10
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+os.environ.setdefault("TOKENS", '{"bot": "offline", "gpt": "offline"}')
+
+from loguru import logger
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from iqbot.config import settings
+from iqbot.telemetry import percentile
+
+GUILD_ID = 1
+
+
+async def run(profile: str, args: argparse.Namespace) -> None:
+    from iqbot import db
+
+    directory = tempfile.TemporaryDirectory()
+    url = f"sqlite+aiosqlite:///{os.path.join(directory.name, 'bench.db')}"
+    if profile == "default":
+        engine = create_async_engine(
+            url, pool_size=10, max_overflow=20, pool_timeout=30
+        )
+    else:
+        engine = db.create_engine(settings.database.model_copy(update={"url": url}))
+    db.engine = engine
+    db.async_session = async_sessionmaker(engine, expire_on_commit=False)
+    db.settlements.update(settled=0, retries=0, failed=0, missing=0)
+    await db.async_main()
+
+    user_ids = list(range(1, args.users + 1))
+    for start in range(0, len(user_ids), 100):
+        await db.read_or_add_users(GUILD_ID, user_ids[start : start + 100])
+
+    reads: list[float] = []
+    writes: list[float] = []
+    errors = 0
+    deadline = time.perf_counter() + args.duration
+
+    async def rate(user1, user2):
+        user1.iq += 1
+        user2.iq -= 1
+        user1.num_bets += 1
+        user2.num_bets += 1
+        return user1, user2
+
+    async def reader() -> None:
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                await db.read_user(GUILD_ID, random.choice(user_ids))
+                reads.append(time.perf_counter() - start)
+            except Exception as e:
+                logger.error(f"Read failed: {e}")
+                errors += 1
+            await asyncio.sleep(args.think)
+
+    async def writer() -> None:
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            user_id_1, user_id_2 = random.sample(user_ids, 2)
+            start = time.perf_counter()
+            try:
+                await db.settle_bet(GUILD_ID, user_id_1, user_id_2, rate)
+                writes.append(time.perf_counter() - start)
+            except Exception as e:
+                logger.error(f"Settlement failed: {e}")
+                errors += 1
+            await asyncio.sleep(args.think)
+
+    await asyncio.gather(
+        *(reader() for _ in range(args.readers)),
+        *(writer() for _ in range(args.writers)),
+    )
+    await engine.dispose()
+    directory.cleanup()
+
+    print(
+        f"{profile:>8}: {len(reads) / args.duration:8.1f} reads/s "
+        f"(p50 {percentile(reads, 50) * 1000:.1f}ms p95 "
+        f"{percentile(reads, 95) * 1000:.1f}ms p99 {percentile(reads, 99) * 1000:.1f}ms), "
+        f"{len(writes) / args.duration:6.1f} writes/s "
+        f"(p50 {percentile(writes, 50) * 1000:.1f}ms p95 "
+        f"{percentile(writes, 95) * 1000:.1f}ms), "
+        f"{db.settlements['retries']} retries, {errors} errors"
+    )
+
+
+async def async_main(args: argparse.Namespace) -> None:
+    if not args.verbose:
+        logger.remove()
+    settings.database.cache.enabled = False
+    for profile in args.profiles:
+        await run(profile, args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--profiles",
+        nargs="+",
+        choices=["default", "tuned"],
+        default=["default", "tuned"],
+    )
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--readers", type=int, default=16)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument(
+        "--think", type=float, default=0.01, help="pause between a task's queries"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    asyncio.run(async_main(args))
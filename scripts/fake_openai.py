@@ -0,0 +1,239 @@
+"""Local stand-in for the OpenAI chat completions API.
+
+Answers POST /v1/chat/completions with canned "**Winner: <name>**" verdicts,
+with configurable latency, error and 429 injection, and streaming. Prompt
+prefixes shared with recent requests are reported as cached tokens, in
+128-token steps past the first 1024 like OpenAI, and speed the response up
+by --cache-speedup. --invalid-rate makes --invalid-model answer without a
+verdict line. Point the
+bot at it with `base_url = "http://127.0.0.1:8089/v1"` under [gpt] in
+.secrets.toml, or use it from scripts/load_bets.py.
+
+    python scripts/fake_openai.py --latency lognormal:0.8,0.4 --rate-limit-rate 0.05
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import re
+import time
+import uuid
+from collections import deque
+from typing import Callable
+
+from aiohttp import web
+
+SUMMARY = (
+    "{winner} addressed the central disagreement directly and backed the key "
+    "premise with a concrete example, while {loser} relied on assertion and "
+    "shifted the topic when pressed. {winner}'s argument was also internally "
+    "consistent throughout."
+)
+
+
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    """`fixed:S`, `uniform:A,B`, `lognormal:MEDIAN,SIGMA` or
+    `pareto:SCALE,ALPHA`, all in seconds."""
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",")] if args else []
+    if kind == "fixed":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "lognormal":
+        mu = math.log(values[0])
+        return lambda rng: rng.lognormvariate(mu, values[1])
+    if kind == "pareto":
+        return lambda rng: values[0] * rng.paretovariate(values[1])
+    raise argparse.ArgumentTypeError(f"Unknown latency distribution: {spec}")
+
+
+class FakeOpenAI:
+    def __init__(
+        self,
+        latency: Callable[[random.Random], float],
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        retry_after: float = 1.0,
+        chunk_delay: float = 0.02,
+        cache_speedup: float = 0.5,
+        invalid_rate: float = 0.0,
+        invalid_model: str = "",
+        seed: int = 0,
+    ) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.chunk_delay = chunk_delay
+        self.cache_speedup = cache_speedup
+        self.invalid_rate = invalid_rate
+        self.invalid_model = invalid_model
+        self.prompts: deque[str] = deque(maxlen=64)
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        return app
+
+    def verdict(self, messages: list[dict], model: str) -> str:
+        if model == self.invalid_model and self.rng.random() < self.invalid_rate:
+            return "Both users made some points, hard to say who won really."
+        prompt = messages[-1]["content"] if messages else ""
+        match = re.search(r"Who won the argument, (.+?) or (.+?)\?", prompt)
+        match = match or re.search(r"between (\S+) and (\S+?)[\s.]", prompt)
+        if match is None:
+            return "**Winner: none**\n\nThere was no meaningful disagreement."
+        names = list(match.groups())
+        if self.rng.random() < 0.1:
+            return f"**Winner: draw**\n\nBoth {names[0]} and {names[1]} argued well."
+        self.rng.shuffle(names)
+        return f"**Winner: {names[0]}**\n\n" + SUMMARY.format(
+            winner=names[0], loser=names[1]
+        )
+
+    def cached_tokens(self, prompt: str) -> int:
+        prefix = max(
+            (len(os.path.commonprefix([prompt, seen])) for seen in self.prompts),
+            default=0,
+        )
+        self.prompts.append(prompt)
+        tokens = prefix // 4
+        return tokens // 128 * 128 if tokens >= 1024 else 0
+
+    def usage(self, prompt: str, cached_tokens: int, content: str) -> dict:
+        prompt_tokens = len(prompt) // 4
+        completion_tokens = len(content) // 4
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        }
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        body = await request.json()
+        messages = body.get("messages", [])
+        prompt = "".join(f"{m['role']}:{m.get('content', '')}\n" for m in messages)
+        cached = self.cached_tokens(prompt)
+        speedup = self.cache_speedup * cached / max(len(prompt) // 4, 1)
+        await asyncio.sleep(self.latency(self.rng) * (1 - speedup))
+
+        roll = self.rng.random()
+        if roll < self.rate_limit_rate:
+            self.rate_limited += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "requests"}},
+                status=429,
+                headers={"retry-after": str(self.retry_after)},
+            )
+        if roll < self.rate_limit_rate + self.error_rate:
+            self.errors += 1
+            return web.json_response(
+                {"error": {"message": "The server had an error", "type": "server"}},
+                status=500,
+            )
+
+        model = body.get("model", "gpt-4o")
+        content = self.verdict(messages, model)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        if not body.get("stream"):
+            return web.json_response(
+                {
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": content},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": self.usage(prompt, cached, content),
+                }
+            )
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        def chunk(delta: dict, finish_reason=None, usage=None) -> bytes:
+            data = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": (
+                    [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+                    if usage is None
+                    else []
+                ),
+            }
+            if usage is not None:
+                data["usage"] = usage
+            return f"data: {json.dumps(data)}\n\n".encode()
+
+        await response.write(chunk({"role": "assistant", "content": ""}))
+        for piece in re.findall(r"\S+\s*", content):
+            await asyncio.sleep(self.chunk_delay)
+            await response.write(chunk({"content": piece}))
+        await response.write(chunk({}, finish_reason="stop"))
+        if (body.get("stream_options") or {}).get("include_usage"):
+            await response.write(chunk({}, usage=self.usage(prompt, cached, content)))
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+
+async def serve(fake: FakeOpenAI, host: str, port: int) -> web.AppRunner:
+    runner = web.AppRunner(fake.app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+async def async_main(args: argparse.Namespace) -> None:
+    fake = FakeOpenAI(
+        latency=args.latency,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after=args.retry_after,
+        chunk_delay=args.chunk_delay,
+        cache_speedup=args.cache_speedup,
+        invalid_rate=args.invalid_rate,
+        invalid_model=args.invalid_model,
+        seed=args.seed,
+    )
+    await serve(fake, args.host, args.port)
+    print(f"Fake OpenAI listening on http://{args.host}:{args.port}/v1")
+    await asyncio.Event().wait()
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--latency", type=parse_latency, default="fixed:0.5")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--chunk-delay", type=float, default=0.02)
+    parser.add_argument("--cache-speedup", type=float, default=0.5)
+    parser.add_argument("--invalid-rate", type=float, default=0.0)
+    parser.add_argument("--invalid-model", default="gpt-4o-mini")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    add_arguments(parser)
+    asyncio.run(async_main(parser.parse_args()))
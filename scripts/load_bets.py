@@ -0,0 +1,230 @@
+"""End-to-end load test for bet resolution.
+
+Starts scripts/fake_openai.py in-process, points the GPT client and a
+throwaway SQLite database at it, and pushes concurrent bet resolutions
+through the real Betting cog (`accept_bet`, or `.evaluate` with
+--command evaluate). Reports throughput, latency percentiles and errors.
+
+    python scripts/load_bets.py --bets 500 --latency lognormal:1.0,0.5 \\
+        --rate-limit-rate 0.02 --concurrency 16
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+os.environ.setdefault("TOKENS", '{"bot": "offline", "gpt": "offline"}')
+
+from bench_context import FakeChannel, WordEncoding, make_channel
+from discord.ext.commands import Context
+from fake_openai import FakeOpenAI, add_arguments, serve
+from loguru import logger
+
+from iqbot import tokens
+from iqbot.config import settings
+from iqbot.telemetry import percentile
+
+
+class FakeSentMessage:
+    def __init__(self, content: str) -> None:
+        self.content = content
+
+    async def edit(self, content: str) -> None:
+        self.content = content
+
+
+class LoadChannel(FakeChannel):
+    def __init__(self, channel: FakeChannel) -> None:
+        super().__init__(channel.id, channel.messages)
+        self.sent: list[FakeSentMessage] = []
+
+    async def send(self, content: str) -> FakeSentMessage:
+        message = FakeSentMessage(content)
+        self.sent.append(message)
+        return message
+
+
+class FakeGuild:
+    def __init__(self, id: int) -> None:
+        self.id = id
+
+    async def fetch_member(self, user_id: int) -> SimpleNamespace:
+        name = f"user{user_id - 1000}"
+        return SimpleNamespace(
+            id=user_id, name=name, display_name=name.title(), mention=f"<@{user_id}>"
+        )
+
+
+class LoadContext(Context):
+    channel = None
+    guild = None
+
+    def __init__(self, channel: LoadChannel, guild: FakeGuild) -> None:
+        self.channel = channel
+        self.guild = guild
+
+
+class FakeBot:
+    user = SimpleNamespace(id=1, bot=True)
+
+    async def wait_until_ready(self) -> None:
+        await asyncio.Event().wait()
+
+
+async def async_main(args: argparse.Namespace) -> None:
+    from iqbot import db, gpt
+    from iqbot.cogs.betting import Betting
+    from iqbot.db import Bet
+
+    if not args.verbose:
+        logger.remove()
+
+    fake = FakeOpenAI(
+        latency=args.latency,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after=args.retry_after,
+        chunk_delay=args.chunk_delay,
+        cache_speedup=args.cache_speedup,
+        invalid_rate=args.invalid_rate,
+        invalid_model=args.invalid_model,
+        seed=args.seed,
+    )
+    runner = await serve(fake, "127.0.0.1", args.port)
+    await db.async_main()
+
+    guild = FakeGuild(args.seed)
+    channel = LoadChannel(make_channel(args.history, seed=args.seed))
+    for message in channel.messages:
+        message.guild = guild
+        message.channel = channel
+    gpt.buffers.buffers.clear()
+    cog = Betting(FakeBot())  # type: ignore
+
+    authors = sorted({m.author.id for m in channel.messages if not m.author.bot})
+    bets = []
+    for i in range(args.bets):
+        user_id_1 = authors[i % len(authors)]
+        user_id_2 = authors[(i + 1 + i // len(authors)) % len(authors)]
+        if user_id_2 == user_id_1:
+            user_id_2 = authors[(i + 1) % len(authors)]
+        bet = Bet(
+            guild_id=guild.id,
+            message_id=channel.messages[-1].id + i + 1,
+            timestamp=datetime.now(),
+            user_id_1=user_id_1,
+            user_id_2=user_id_2,
+        )
+        await db.add_bet(bet)
+        bets.append(bet)
+
+    limit = asyncio.Semaphore(args.concurrency)
+    latencies: list[float] = []
+
+    async def resolve(bet) -> None:
+        async with limit:
+            start = time.perf_counter()
+            if args.command == "bet":
+                await cog.accept_bet(channel.messages[-1], bet)
+            else:
+                ctx = LoadContext(channel, guild)
+                member1 = await guild.fetch_member(bet.user_id_1)
+                member2 = await guild.fetch_member(bet.user_id_2)
+                await cog.evaluate.callback(
+                    cog, ctx, member1, member2, topic="whatever they argued about"
+                )
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(resolve(bet) for bet in bets))
+    elapsed = time.perf_counter() - start
+    cog.expiry_scheduler.cancel()
+    await runner.cleanup()
+
+    failures = sum("error occurred" in m.content.lower() for m in channel.sent)
+    print(
+        f"{args.bets} {args.command} resolutions in {elapsed:.2f}s "
+        f"({args.bets / elapsed:.1f}/s), {failures} failed"
+    )
+    print(
+        f"latency p50 {percentile(latencies, 50):.3f}s  "
+        f"p95 {percentile(latencies, 95):.3f}s  p99 {percentile(latencies, 99):.3f}s  "
+        f"max {max(latencies):.3f}s"
+    )
+    print(
+        f"fake server: {fake.requests} requests, {fake.rate_limited} rate limited, "
+        f"{fake.errors} errors; verdict cache {gpt.verdicts.hits} hits, "
+        f"user cache {db.users.stats()['hit_rate']:.0%} hit rate"
+    )
+    print(
+        f"settlements: {db.settlements['settled']} settled, "
+        f"{db.settlements['retries']} retries, {db.settlements['failed']} failed, "
+        f"{db.settlements['missing']} missing"
+    )
+    total = gpt.telemetry.total()
+    models = ", ".join(
+        f"{model} {stats['calls']}"
+        for model, stats in gpt.telemetry.group("model").items()
+    )
+    print(
+        f"telemetry: calls by model {models}; ttfb p50 {total['ttfb_p50']:.3f}s p95 {total['ttfb_p95']:.3f}s, "
+        f"{total['retries']} retries, {total['hedges']} hedges, "
+        f"{total['rejected']} rejected, "
+        f"{total['fallbacks']} fallbacks, {total['prompt_tokens']}+"
+        f"{total['completion_tokens']} tokens ({total['cached_tokens']} cached), "
+        f"${total['cost']:.4f} (saved ${total['saved']:.4f})"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--command", choices=["bet", "evaluate"], default="bet")
+    parser.add_argument("--bets", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--history", type=int, default=300)
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--gpt-concurrency", type=int, default=16)
+    parser.add_argument("--rpm", type=int, default=100000)
+    parser.add_argument("--tpm", type=int, default=100000000)
+    parser.add_argument("--no-stream", action="store_true")
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--layout", choices=["inline", "prefix"], default="prefix")
+    parser.add_argument("--hedge", action="store_true")
+    parser.add_argument("--no-router", action="store_true")
+    parser.add_argument("--token-limit", type=int)
+    parser.add_argument("--deadline", type=float)
+    parser.add_argument("--approx-tokens", action="store_true")
+    parser.add_argument("--verbose", action="store_true")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    # gpt and db build their client, scheduler and engine on import, so the
+    # overrides have to be in place before async_main imports them.
+    database = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+    settings.database.url = f"sqlite+aiosqlite:///{database.name}"
+    settings.gpt.base_url = f"http://127.0.0.1:{args.port}/v1"
+    settings.gpt.concurrency = args.gpt_concurrency
+    settings.gpt.scheduler.rpm = args.rpm
+    settings.gpt.scheduler.tpm = args.tpm
+    settings.gpt.stream.enabled = not args.no_stream
+    settings.gpt.prompt.layout = args.layout
+    settings.gpt.retry.hedge.enabled = args.hedge
+    settings.gpt.router.enabled = not args.no_router
+    if args.token_limit is not None:
+        settings.gpt.tokens.limit = args.token_limit
+    settings.gpt.retry.backoff_base = 0.1
+    if args.deadline is not None:
+        settings.gpt.retry.deadline = args.deadline
+    if args.no_cache:
+        settings.gpt.cache.size = 0
+    if args.approx_tokens:
+        tokens.get_encoding = lambda model: WordEncoding()  # type: ignore
+
+    try:
+        asyncio.run(async_main(args))
+    finally:
+        os.unlink(database.name)
@@ -1,13 +1,14 @@
 # type: ignore
 
 import asyncio
-import os
 
 from discord import Intents
 from discord.ext import commands
 from discord.ext.commands import Context
 from loguru import logger
 
+from alembic import command
+from alembic.config import Config
 from iqbot import cogs, db
 from iqbot.config import settings
 
@@ -17,9 +18,10 @@ for i in range(5):
 intents = Intents(**settings.bot.intents.model_dump())
 bot = commands.Bot(command_prefix=settings.bot.prefix, intents=intents)
 
-if not os.path.exists("data.db"):
-    logger.info("Initializing database...")
-    asyncio.run(db.async_main())
+if asyncio.run(db.create_schema()):
+    # The tables match the models, so mark every migration as applied.
+    logger.info("Initialized database schema")
+    command.stamp(Config("alembic.ini"), "head")
 
 for cog in settings.bot.cogs:
     logger.info(f"Loading {cog} cog...")
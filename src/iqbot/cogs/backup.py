@@ -3,40 +3,134 @@ import gzip
 import os
 import re
 import shutil
+import sqlite3
+import subprocess
+import tempfile
 from datetime import datetime, timedelta
 from typing import Any
-from urllib.parse import urlparse
 
 import discord
 from discord.commands import Option, SlashCommandGroup
 from discord.ext import commands, tasks
 from loguru import logger
+from sqlalchemy.engine import URL
 
+from iqbot import db
 from iqbot.checks import bot_owner
 from iqbot.config import settings
 
+# SQLite databases are backed up as gzipped database files, PostgreSQL ones
+# as pg_dump archives in its (already compressed) custom format.
+BACKUP_NAME = re.compile(r"^backup_(\d+_\d+)\.(sqlite3\.gz|dump)$")
+
+
+def is_backup(filename: str) -> bool:
+    return BACKUP_NAME.match(filename) is not None
+
+
+def postgres() -> bool:
+    return db.engine.dialect.name == "postgresql"
+
+
+def database_path() -> str:
+    assert db.engine.url.database is not None
+    return db.engine.url.database
+
+
+def run_pg(program: str, *args: str) -> None:
+    """Run a PostgreSQL client program against the configured database,
+    passing the password through the environment rather than the command
+    line."""
+    url = db.engine.url
+    env = dict(os.environ)
+    if url.password:
+        env["PGPASSWORD"] = str(url.password)
+    dbname = URL.create(
+        "postgresql",
+        username=url.username,
+        host=url.host,
+        port=url.port,
+        database=url.database,
+    )
+    subprocess.run(
+        [program, *args, f"--dbname={dbname.render_as_string()}"],
+        check=True,
+        capture_output=True,
+        env=env,
+    )
+
+
+def copy_database(source: str, target: str) -> None:
+    """Copy one SQLite database into another with SQLite's backup API. In WAL
+    mode recent commits can still be in the -wal file, so copying the main
+    file alone would lose them, and overwriting it under open connections
+    would corrupt it."""
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(target)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
 
 def create_backup() -> str:
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    if postgres():
+        filename = f"backup_{timestamp}.dump"
+        path = os.path.join(settings.database.backup_dir, filename)
+        run_pg("pg_dump", "--format=custom", f"--file={path}")
+        logger.info(f"Created backup: {filename}")
+        remove_old_backups()
+        return filename
+
     filename = f"backup_{timestamp}.sqlite3.gz"
     path = os.path.join(settings.database.backup_dir, filename)
-
-    with (
-        open(urlparse(settings.database.url).path.lstrip("/"), "rb") as f_in,
-        gzip.open(path, "wb") as f_out,
-    ):
-        shutil.copyfileobj(f_in, f_out)
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot = os.path.join(tmp, "snapshot.sqlite3")
+        copy_database(database_path(), snapshot)
+        # The copy keeps the source's journal mode; switch it back so the
+        # archive is a single self-contained file.
+        with sqlite3.connect(snapshot) as conn:
+            conn.execute("PRAGMA journal_mode=delete")
+        conn.close()
+        with open(snapshot, "rb") as f_in, gzip.open(path, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
 
     logger.info(f"Created backup: {filename}")
     remove_old_backups()
     return filename
 
 
+def restore_backup(path: str) -> None:
+    if path.endswith(".dump") != postgres():
+        raise ValueError(
+            f"not a backup of a {db.engine.dialect.name} database: "
+            f"{os.path.basename(path)}"
+        )
+    if postgres():
+        run_pg(
+            "pg_restore",
+            "--clean",
+            "--if-exists",
+            "--no-owner",
+            "--single-transaction",
+            path,
+        )
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            snapshot = os.path.join(tmp, "snapshot.sqlite3")
+            with gzip.open(path, "rb") as f_in, open(snapshot, "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            copy_database(snapshot, database_path())
+    db.clear_caches()
+
+
 def remove_old_backups():
     now = datetime.now()
     for backup in os.listdir(settings.database.backup_dir):
         try:
-            match = re.search(r"^backup_(\d+_\d+)\.sqlite3\.gz$", backup)
+            match = BACKUP_NAME.match(backup)
             if not match:
                 logger.warning(f"Failed to match timestamp in filename: {backup}")
                 continue
@@ -56,7 +150,7 @@ async def get_backup_choices(
         files = sorted(
             f
             for f in os.listdir(settings.database.backup_dir)
-            if f.endswith(".gz") and query.lower() in f.lower()
+            if is_backup(f) and query.lower() in f.lower()
         )
         return [discord.OptionChoice(name=f, value=f) for f in files[:25]]
     except Exception as e:
@@ -93,7 +187,7 @@ class Backup(commands.Cog):
         await ctx.defer(ephemeral=True)
         try:
             files = sorted(
-                f for f in os.listdir(settings.database.backup_dir) if f.endswith(".gz")
+                f for f in os.listdir(settings.database.backup_dir) if is_backup(f)
             )
             if not files:
                 await ctx.respond("No backups found.", ephemeral=True)
@@ -121,11 +215,7 @@ class Backup(commands.Cog):
             logger.warning(f"Attempted to restore missing backup: {filename}")
             return
         try:
-            with (
-                gzip.open(path, "rb") as f_in,
-                open(urlparse(settings.database.url).path.lstrip("/"), "wb") as f_out,
-            ):
-                shutil.copyfileobj(f_in, f_out)
+            restore_backup(path)
             await ctx.respond(
                 f"Backup `{filename}` restored successfully.", ephemeral=True
             )
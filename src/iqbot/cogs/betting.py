@@ -1,21 +1,23 @@
+import asyncio
 import datetime
+import heapq
 import re
 from datetime import datetime, timedelta
 from enum import Enum
 from math import sqrt
-from typing import Any
+from typing import Any, Optional
 
-from discord import ApplicationContext, Member
+from discord import ApplicationContext, Member, Message, Object, RawReactionActionEvent
 from discord.commands import Option
 from discord.ext import commands, tasks
 from discord.ext.commands import Bot
 from loguru import logger
-from sqlalchemy import select
 
 from iqbot import db, gpt
 from iqbot.checks import bot_manager, bot_owner
 from iqbot.config import settings
 from iqbot.db import Bet, User
+from iqbot.streaming import stream_reply
 
 
 class BetResult(Enum):
@@ -30,10 +32,22 @@ class Betting(commands.Cog):
     bot: commands.Bot
     muted: bool
     whitelist: dict[int, int]
+    # Bets awaiting an answer, by challenge message id, and a min-heap of
+    # their (deadline, message_id). A heap entry is stale, and skipped, once
+    # its bet has left `pending`.
+    pending: dict[int, Bet]
+    expiries: list[tuple[datetime, int]]
+    wakeup: asyncio.Event
 
     def __init__(self, bot: Bot, **kwargs):
         self.bot = bot
-        self.bet_timer.start()
+        self.pending = {}
+        self.expiries = []
+        self.wakeup = asyncio.Event()
+        self.expiry_scheduler.start()
+
+    def cog_unload(self):
+        self.expiry_scheduler.cancel()
 
     def resolve_winner(
         self, member1: Member, member2: Member, winner: str
@@ -46,6 +60,14 @@ class Betting(commands.Cog):
         }
         return winner_map.get(winner.lower(), BetResult.ERROR)
 
+    def parse_winner(self, response: str) -> Optional[str]:
+        match = re.search(r"(?<=winner:\s).+(?=\*\*)", response.lower())
+        return match.group(0).strip() if match is not None else None
+
+    def valid_verdict(self, member1: Member, member2: Member, response: str) -> bool:
+        winner = self.parse_winner(response)
+        return winner in (member1.name.lower(), member2.name.lower(), "draw", "none")
+
     def calculate_k(self, user: User) -> float:
         assert user.iq is not None
         deviation = abs(user.iq - 100)
@@ -78,110 +100,246 @@ class Betting(commands.Cog):
 
         return user1, user2
 
-    @tasks.loop(minutes=30)
-    async def bet_timer(self) -> None:
-        async with db.get_session() as session:
-            result = await session.execute(select(Bet))
-            bets = result.scalars()
-            for bet in bets:
-                if datetime.now() - bet.timestamp > timedelta(minutes=10):
-                    logger.info(f"Deleting bet {bet.message_id} after 10 minutes")
-                    await session.delete(bet)
-            await session.commit()
-
-    @bet_timer.before_loop
-    async def before_backup_task(self):
-        await self.bot.wait_until_ready()
+    async def settle(
+        self,
+        guild_id: int,
+        user_id_1: int,
+        user_id_2: int,
+        result: BetResult,
+        message_id: Optional[int] = None,
+    ) -> Optional[tuple[tuple[User, User], tuple[User, User]]]:
+        """Apply the ELO update for `result` and delete the bet, atomically;
+        None if the result does not change ratings."""
+        if result not in (BetResult.USER1, BetResult.USER2, BetResult.DRAW):
+            return None
+        return await db.settle_bet(
+            guild_id,
+            user_id_1,
+            user_id_2,
+            lambda user1, user2: self.update_elo(user1, user2, result),
+            message_id,
+        )
 
-    async def accept_bet(self, reaction, bet) -> None:
-        try:
-            async with db.get_session() as session:
-                bet = await session.merge(bet)
+    def deadline(self, bet: Bet) -> datetime:
+        return bet.timestamp + timedelta(seconds=settings.bet.expiry)
 
-                member1 = await reaction.message.guild.fetch_member(bet.user_id_1)
-                member2 = await reaction.message.guild.fetch_member(bet.user_id_2)
+    def add_pending(self, bet: Bet) -> None:
+        self.pending[bet.message_id] = bet
+        heapq.heappush(self.expiries, (self.deadline(bet), bet.message_id))
+        if self.expiries[0][1] == bet.message_id:
+            self.wakeup.set()
 
-                user1 = await db.read_or_add_user(bet.guild_id, bet.user_id_1)
-                user2 = await db.read_or_add_user(bet.guild_id, bet.user_id_2)
+    def pop_pending(self, message_id: int) -> Optional[Bet]:
+        """Take a bet out of the index, cancelling its expiry. Only the first
+        caller gets the bet, so an answer and an expiry cannot both run."""
+        return self.pending.pop(message_id, None)
 
-                start_iq1 = user1.iq
-                start_iq2 = user2.iq
+    async def announce_expiry(self, bet: Bet) -> None:
+        if bet.channel_id is None:
+            return
+        try:
+            channel = self.bot.get_partial_messageable(bet.channel_id)
+            await channel.get_partial_message(bet.message_id).edit(
+                content=f"<@{bet.user_id_2}> did not answer <@{bet.user_id_1}>'s challenge in time. **This bet has expired.**"
+            )
+        except Exception as e:
+            logger.warning(f"Failed to mark bet {bet.message_id} as expired: {e}")
+
+    async def load_expiries(self) -> None:
+        """Expire the bets that ran out while the bot was offline, in one
+        DELETE, and schedule the rest."""
+        cutoff = datetime.now() - timedelta(seconds=settings.bet.expiry)
+        expired = await db.remove_expired_bets(cutoff)
+        for bet in expired:
+            await self.announce_expiry(bet)
+        bets = await db.read_bets()
+        for bet in bets:
+            self.add_pending(bet)
+        logger.info(f"Expired {len(expired)} stale bets, {len(bets)} pending")
+
+    @tasks.loop(count=1)
+    async def expiry_scheduler(self) -> None:
+        """Runs for the life of the cog, sleeping until the earliest deadline
+        or until a new bet wakes it, and expires each bet on time."""
+        try:
+            await self.load_expiries()
+        except Exception as e:
+            logger.error(f"Error loading pending bets: {e}")
+
+        while True:
+            self.wakeup.clear()
+            if not self.expiries:
+                await self.wakeup.wait()
+                continue
+            deadline, message_id = self.expiries[0]
+            delay = (deadline - datetime.now()).total_seconds()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self.expiries)
+            bet = self.pending.get(message_id)
+            if bet is None or self.deadline(bet) != deadline:
+                continue
+            del self.pending[message_id]
+            try:
+                bet = await db.remove_bet(message_id)
+            except Exception as e:
+                logger.error(f"Error expiring bet {message_id}: {e}")
+                continue
+            if bet is not None:
+                logger.info(f"Bet {message_id} expired")
+                await self.announce_expiry(bet)
+
+    @expiry_scheduler.before_loop
+    async def before_expiry_scheduler(self):
+        await self.bot.wait_until_ready()
 
-                prompt = f"Who won the argument, {member1.name} or {member2.name}?"
+    async def accept_bet(self, message: Message, bet: Bet) -> None:
+        settlement: Optional[asyncio.Task] = None
+        try:
+            member1 = await message.guild.fetch_member(bet.user_id_1)
+            member2 = await message.guild.fetch_member(bet.user_id_2)
+
+            prompt = f"Who won the argument, {member1.name} or {member2.name}?"
+            participants = [member1.id, member2.id]
+
+            def display(text: str) -> str:
+                text = text.replace(member1.name, member1.display_name)
+                return text.replace(member2.name, member2.display_name)
+
+            def validate(text: str) -> bool:
+                return self.valid_verdict(member1, member2, text)
+
+            def settle_early(text: str) -> None:
+                # Start the ELO update as soon as the winner line is
+                # complete instead of waiting for the whole summary.
+                nonlocal settlement
+                if settlement is None and validate(text):
+                    winner = self.parse_winner(text) or "none"
+                    result = self.resolve_winner(member1, member2, winner)
+                    settlement = asyncio.create_task(
+                        self.settle(
+                            bet.guild_id,
+                            bet.user_id_1,
+                            bet.user_id_2,
+                            result,
+                            bet.message_id,
+                        )
+                    )
+
+            if settings.gpt.stream.enabled:
+                await stream_reply(
+                    gpt.stream_prompt(
+                        message,
+                        settings.gpt.system_prompt,
+                        prompt,
+                        participants,
+                        "bet",
+                        validate,
+                    ),
+                    message.channel.send,
+                    display,
+                    settle_early,
+                )
+            else:
                 gpt_response = await gpt.send_prompt(
-                    reaction, settings.gpt.system_prompt, prompt
+                    message,
+                    settings.gpt.system_prompt,
+                    prompt,
+                    participants,
+                    "bet",
+                    validate,
                 )
-                match = re.search(r"(?<=winner:\s).+(?=\*\*)", gpt_response.lower())
-
-                gpt_response = gpt_response.replace(member1.name, member1.display_name)
-                gpt_response = gpt_response.replace(member2.name, member2.display_name)
-
-                winner = match.group(0).strip() if match is not None else "error"
-                result = self.resolve_winner(member1, member2, winner)
-
-                if result in (BetResult.USER1, BetResult.USER2, BetResult.DRAW):
-                    user1, user2 = await self.update_elo(user1, user2, result)
-                    user1 = await session.merge(user1)
-                    user2 = await session.merge(user2)
-                    await session.commit()
-
-                await reaction.message.channel.send(gpt_response[0:1999])
-                await reaction.message.channel.send(
-                    f"{member1.display_name}\n{member1.mention} **IQ {start_iq1} -> {user1.iq}**\n{member2.mention} **IQ {start_iq2} -> {user2.iq}**"
+                settle_early(gpt_response)
+                await message.channel.send(display(gpt_response)[0:1999])
+
+            settled = await settlement if settlement is not None else None
+            if settled is None:
+                await db.remove_bet(bet.message_id)
+                before = after = await db.read_or_add_users(
+                    bet.guild_id, [bet.user_id_1, bet.user_id_2]
                 )
+            else:
+                before, after = settled
+
+            await message.channel.send(
+                f"{member1.display_name}\n{member1.mention} **IQ {before[0].iq} -> {after[0].iq}**\n{member2.mention} **IQ {before[1].iq} -> {after[1].iq}**"
+            )
 
+        except db.BetNotFound as e:
+            logger.warning(f"Skipped settlement: {e}")
+            await message.channel.send("**This bet has already been settled.**")
         except Exception as e:
-            await session.delete(bet)
-            await session.commit()
-            logger.error(f"Error in on_reaction_add: {e}")
-            await reaction.message.channel.send(
-                f"**Error occurred while processing the bet. {reaction.message.jump_url}**"
+            logger.error(f"Error in on_raw_reaction_add: {e}")
+            # A verdict may already be settling. Let it finish rather than
+            # tell the users the bet failed after their IQs changed.
+            if settlement is not None:
+                try:
+                    if await settlement is not None:
+                        await message.channel.send(
+                            f"**The bet was settled, but an error occurred while responding. {message.jump_url}**"
+                        )
+                        return
+                except Exception as e:
+                    logger.error(f"Error settling bet {bet.message_id}: {e}")
+            await db.remove_bet(bet.message_id)
+            await message.channel.send(
+                f"**Error occurred while processing the bet. {message.jump_url}**"
             )
 
-    async def decline_bet(self, reaction, user, bet) -> None:
+    async def decline_bet(self, message: Message, bet: Bet) -> None:
         try:
-            async with db.get_session() as session:
-                bet = await session.merge(bet)
-                await session.delete(bet)
-                await session.commit()
-                await reaction.message.channel.send(
-                    f"**{user.mention} has declined the bet against {reaction.message.mentions[1].mention}.**"
-                )
+            await db.remove_bet(bet.message_id)
+            await message.channel.send(
+                f"**<@{bet.user_id_2}> has declined the bet against <@{bet.user_id_1}>.**"
+            )
         except Exception as e:
-            logger.error(f"Error in on_reaction_add: {e}")
-            await reaction.message.channel.send(
-                f"**Error occurred while processing the bet. {reaction.message.jump_url}**"
+            logger.error(f"Error in on_raw_reaction_add: {e}")
+            await message.channel.send(
+                f"**Error occurred while processing the bet. {message.jump_url}**"
             )
 
     @commands.Cog.listener()
-    async def on_reaction_add(self, reaction, user):
-        if user.bot:
+    async def on_raw_reaction_add(self, payload: RawReactionActionEvent):
+        # Fires for uncached messages too. Anything but a pending bet is
+        # ignored here, before any lookup.
+        bet = self.pending.get(payload.message_id)
+        if bet is None:
             return
 
-        if reaction.message.author != self.bot.user:
+        if payload.member is None or payload.member.bot:
             return
 
-        if reaction.emoji not in ["✅", "❌"]:
-            logger.info(f"Reaction added: {reaction.emoji} by {user.name}")
-            await reaction.message.remove_reaction(reaction.emoji, user)
+        emoji = str(payload.emoji)
+        if emoji not in ["✅", "❌"] or payload.user_id != bet.user_id_2:
+            logger.info(f"Reaction added: {emoji} by {payload.member.name}")
+            challenge = self.bot.get_partial_messageable(
+                payload.channel_id
+            ).get_partial_message(payload.message_id)
+            await challenge.remove_reaction(payload.emoji, Object(payload.user_id))
             return
 
-        bet = await db.read_bet(reaction.message.id)
-        if bet is None:
+        if self.pop_pending(payload.message_id) is None:
             return
 
-        if user.id != bet.user_id_2:
-            await reaction.message.remove_reaction(reaction.emoji, user)
+        try:
+            message = self.bot.get_message(payload.message_id)
+            if message is None:
+                channel = self.bot.get_channel(payload.channel_id)
+                message = await channel.fetch_message(payload.message_id)
+        except Exception as e:
+            self.add_pending(bet)
+            logger.error(f"Error fetching bet message {payload.message_id}: {e}")
             return
 
-        if reaction.emoji == "✅":
-            await self.accept_bet(reaction, bet)
-
-        elif reaction.emoji == "❌":
-            await self.decline_bet(reaction, user, bet)
-
+        if emoji == "✅":
+            await self.accept_bet(message, bet)
         else:
-            return
+            await self.decline_bet(message, bet)
 
     @commands.slash_command(name="bet", description="Initiates a bet between two users")
     async def bet(self, ctx: ApplicationContext, member: Member):
@@ -201,17 +359,16 @@ class Betting(commands.Cog):
         await message.add_reaction("✅")
         await message.add_reaction("❌")
 
-        async with db.get_session() as session:
-            bet = Bet(
-                guild_id=ctx.guild.id,
-                message_id=message.id,
-                timestamp=message.created_at,
-                user_id_1=ctx.author.id,
-                user_id_2=member.id,
-            )
-            session.add(bet)
-            await session.commit()
-            logger.info(f"Bet added to DB: {bet}")
+        bet = Bet(
+            guild_id=ctx.guild.id,
+            message_id=message.id,
+            user_id_1=ctx.author.id,
+            user_id_2=member.id,
+            channel_id=message.channel.id,
+        )
+        await db.add_bet(bet)
+        self.add_pending(bet)
+        logger.info(f"Bet added to DB: {bet}")
 
     @commands.command(
         name="evaluate",
@@ -228,21 +385,17 @@ class Betting(commands.Cog):
         try:
             prompt = f"Evaluate the debate between {member1.name} and {member2.name} on the topic: {topic}. Include the topic in the response."
             gpt_response = await gpt.send_prompt(
-                ctx, settings.gpt.system_prompt, prompt
+                ctx,
+                settings.gpt.system_prompt,
+                prompt,
+                [member1.id, member2.id],
+                "evaluate",
+                lambda text: self.valid_verdict(member1, member2, text),
             )
-            match = re.search(r"(?<=winner:\s).+(?=\*\*)", gpt_response.lower())
-
-            winner = match.group(0).strip() if match is not None else "error"
+            winner = self.parse_winner(gpt_response) or "error"
             result = self.resolve_winner(member1, member2, winner)
 
-            if result in (BetResult.USER1, BetResult.USER2, BetResult.DRAW):
-                async with db.get_session() as session:
-                    user1 = await db.read_or_add_user(ctx.guild.id, member1.id)
-                    user2 = await db.read_or_add_user(ctx.guild.id, member2.id)
-                    user1, user2 = await self.update_elo(user1, user2, result)
-                    user1 = await session.merge(user1)
-                    user2 = await session.merge(user2)
-                    await session.commit()
+            await self.settle(ctx.guild.id, member1.id, member2.id, result)
 
             await ctx.channel.send(gpt_response[0:1999])
 
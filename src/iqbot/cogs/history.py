@@ -0,0 +1,33 @@
+from discord import Message
+from discord.ext import commands
+from loguru import logger
+
+from iqbot import gpt
+
+
+class History(commands.Cog):
+    bot: commands.Bot
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    @commands.Cog.listener()
+    async def on_message(self, message: Message):
+        gpt.buffers.add(message)
+
+    @commands.Cog.listener()
+    async def on_message_edit(self, before: Message, after: Message):
+        gpt.buffers.edit(after)
+
+    @commands.Cog.listener()
+    async def on_message_delete(self, message: Message):
+        gpt.buffers.delete(message.channel.id, message.id)
+
+    @commands.Cog.listener()
+    async def on_disconnect(self):
+        logger.info("Disconnected from gateway, message buffers marked cold")
+        gpt.buffers.invalidate()
+
+
+def setup(bot):
+    bot.add_cog(History(bot))
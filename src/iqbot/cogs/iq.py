@@ -1,5 +1,5 @@
 import random
-from typing import Optional
+from typing import Callable, Optional
 
 from discord import Member
 from discord.ext import commands
@@ -105,50 +105,45 @@ class IQ(commands.Cog):
         except Exception as e:
             logger.error(f"Error in ping command: {e}")
 
+    async def present_members(
+        self,
+        ctx,
+        page: Callable[[int, int], list[tuple[int, int]]],
+        exclude: dict[int, tuple[str, int]],
+    ) -> dict[int, tuple[str, int]]:
+        """Up to five `(display name, iq)` from the leaderboard `page` for
+        members still in the guild, stopping at anyone in `exclude`. Users
+        who have left are marked absent, which takes them off the board."""
+        members = {}
+        offset = 0
+        while len(members) < 5:
+            entries = page(5, offset)
+            if not entries:
+                break
+            offset += len(entries)
+            for user_id, iq in entries:
+                if user_id in exclude:
+                    return members
+                try:
+                    member = await ctx.guild.fetch_member(user_id)
+                except Exception:
+                    member = None
+
+                if member:
+                    members[member.id] = (member.display_name, iq)
+                    if len(members) == 5:
+                        break
+                elif await db.update_user_presence(ctx.guild.id, user_id, False):
+                    offset -= 1
+        return members
+
     @commands.slash_command(name="top", description="Outputs top and bottom IQs")
     async def top(self, ctx):
         await ctx.defer()
         try:
-            top_users = {}
-            bottom_users = {}
-
-            async with db.get_session() as session:
-                async for user in db.read_top_iqs(ctx.guild.id):
-                    try:
-                        member = await ctx.guild.fetch_member(user.user_id)
-                    except:
-                        member = None
-
-                    if member:
-                        top_users[member.id] = (member.display_name, user.iq)
-                    else:
-                        await session.merge(user)
-                        user.is_present = False
-                        await session.commit()
-
-                    if len(top_users) == 5:
-                        break
-
-                async for user in db.read_bottom_iqs(ctx.guild.id):
-                    try:
-                        member = await ctx.guild.fetch_member(user.user_id)
-                    except:
-                        member = None
-
-                    if member:
-                        if member.id not in top_users:
-                            bottom_users[member.id] = (member.display_name, user.iq)
-                        else:
-                            break
-                    else:
-                        await session.merge(user)
-                        user.is_present = False
-                        await session.commit()
-
-                    if len(bottom_users) == 5:
-                        break
-
-                await session.commit()
+            board = await db.read_leaderboard(ctx.guild.id)
+            top_users = await self.present_members(ctx, board.top, {})
+            bottom_users = await self.present_members(ctx, board.bottom, top_users)
 
             if not top_users and not bottom_users:
                 await ctx.respond("No qualifying members found.")
@@ -169,6 +164,31 @@ class IQ(commands.Cog):
             logger.error(f"Error in top command: {e}")
             await ctx.respond("Error retrieving IQ data.")
 
+    @commands.slash_command(name="rank", description="Shows a member's IQ rank")
+    async def rank(self, ctx, member: Optional[Member] = None):
+        try:
+            if member is None:
+                member = ctx.author
+
+            await db.read_or_add_user(ctx.guild.id, member.id)
+            board = await db.read_leaderboard(ctx.guild.id)
+            rank = board.rank(member.id)
+            if rank is None:
+                await ctx.respond(f"{member.display_name} is not ranked.")
+                return
+
+            message = f"## {member.display_name} is #{rank} of {len(board)}\n"
+            for other_rank, user_id, iq in board.around(member.id, 2):
+                other = ctx.guild.get_member(user_id)
+                name = other.display_name if other else f"<@{user_id}>"
+                if user_id == member.id:
+                    name = f"**{name}**"
+                message += f"{other_rank}. {name}: {iq} IQ\n"
+            await ctx.respond(message)
+        except Exception as e:
+            logger.error(f"Error in rank command: {e}")
+            await ctx.respond("Error retrieving IQ rank.")
+
 
 def setup(bot):
     bot.add_cog(IQ(bot))
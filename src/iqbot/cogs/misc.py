@@ -5,6 +5,8 @@ from discord.ext import commands
 from loguru import logger
 
 from iqbot import gpt
+from iqbot.config import settings
+from iqbot.streaming import stream_reply
 
 
 class Misc(commands.Cog):
@@ -45,10 +47,25 @@ class Misc(commands.Cog):
             )
 
             prompt = f"Please summarize the conversation between {member1.name} and {member2.name}. \n\n"
-            gpt_response = await gpt.send_prompt(ctx, system_prompt, prompt)
-            gpt_response = gpt_response.replace(member1.name, member1.display_name)
-            gpt_response = gpt_response.replace(member2.name, member2.display_name)
-            await ctx.respond(gpt_response[0:1999])
+            participants = [member1.id, member2.id]
+
+            def display(text: str) -> str:
+                text = text.replace(member1.name, member1.display_name)
+                return text.replace(member2.name, member2.display_name)
+
+            if settings.gpt.stream.enabled:
+                await stream_reply(
+                    gpt.stream_prompt(
+                        ctx, system_prompt, prompt, participants, "steelman"
+                    ),
+                    ctx.respond,
+                    display,
+                )
+            else:
+                gpt_response = await gpt.send_prompt(
+                    ctx, system_prompt, prompt, participants, "steelman"
+                )
+                await ctx.respond(display(gpt_response)[0:1999])
 
         except Exception as e:
             logger.error(f"Error in on_reaction_add: {e}")
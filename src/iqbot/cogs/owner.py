@@ -1,5 +1,6 @@
+import io
+import json
 import re
-import tempfile
 from typing import Optional
 
 from discord import ApplicationContext, File, Member
@@ -8,7 +9,7 @@ from discord.ext import commands
 from discord.ext.commands import Context
 from loguru import logger
 
-from iqbot import db, gpt
+from iqbot import db, dbstats, gpt
 from iqbot.checks import bot_owner
 from iqbot.config import settings
 
@@ -31,19 +32,20 @@ class Owner(commands.Cog):
             logger.error(f"Error parsing message link: {e}")
             return None, None
 
-    async def respond_with_file(self, ctx: Context, content: str) -> None:
-        out = tempfile.NamedTemporaryFile(
-            dir=".", prefix="conversation.", suffix=".txt", delete=False
-        )
-        out.write(content.encode("utf-8"))
-        out.flush()
+    async def respond_with_file(
+        self,
+        ctx: Context,
+        content: str,
+        filename: str = "conversation.txt",
+        ephemeral: bool = False,
+    ) -> None:
+        # Sent from memory, so there is no file on disk to clean up.
         try:
-            file = File(out.name, filename="conversation.txt")
-            await ctx.respond(file=file)  # type: ignore
+            file = File(io.BytesIO(content.encode("utf-8")), filename=filename)
+            await ctx.respond(file=file, ephemeral=ephemeral)  # type: ignore
         except Exception as err:
-            print(err)
-        finally:
-            out.close()
+            logger.error(f"Error sending {filename}: {err}")
+            await ctx.respond(f"Failed to send {filename}", ephemeral=True)
 
     @commands.slash_command(
         name="sync", description="Sync slash commands to whitelisted guilds"
@@ -108,6 +110,137 @@ class Owner(commands.Cog):
                 logger.error(f"Error in dump command: {e}")
                 await ctx.respond("Failed to get the conversation history")
 
+    @owner.command(name="buffers", description="Shows message buffer memory use")
+    @commands.check(bot_owner)
+    async def buffers(self, ctx):
+        stats = gpt.buffers.stats()
+        total = sum(entry["bytes"] for entry in stats.values())
+        message = f"## Message buffers ({total / 1024:.1f} KiB)\n"
+        for channel_id, entry in stats.items():
+            message += (
+                f"- <#{channel_id}>: {entry['messages']} messages, "
+                f"{entry['bytes'] / 1024:.1f}/{entry['max_bytes'] / 1024:.0f} KiB"
+                f"{'' if entry['warm'] else ' (cold)'}\n"
+            )
+        await ctx.respond(message, ephemeral=True)
+
+    @owner.command(name="cache", description="Shows verdict and user cache statistics")
+    @commands.check(bot_owner)
+    async def cache(self, ctx):
+        def line(name: str, stats: dict) -> str:
+            return (
+                f"{name}: {stats['entries']}/{stats['size']} entries, "
+                f"{stats['hits']} hits, {stats['misses']} misses "
+                f"({stats['hit_rate']:.0%} hit rate)"
+            )
+
+        users = line("User cache", db.users.stats())
+        if not settings.database.cache.enabled:
+            users += " (disabled)"
+        await ctx.respond(
+            f"{line('Verdict cache', gpt.verdicts.stats())}\n{users}", ephemeral=True
+        )
+
+    @owner.command(name="queue", description="Shows GPT request queue statistics")
+    @commands.check(bot_owner)
+    async def queue(self, ctx):
+        stats = gpt.scheduler.stats()
+        await ctx.respond(
+            f"GPT queue: {stats['queued']} queued across {stats['guilds']} guild(s), "
+            f"{stats['active']} in flight, wait avg {stats['avg_wait']:.2f}s "
+            f"max {stats['max_wait']:.2f}s"
+            + (
+                f", backing off {stats['paused_for']:.0f}s"
+                if stats["paused_for"]
+                else ""
+            ),
+            ephemeral=True,
+        )
+
+    @owner.command(name="settlements", description="Shows bet settlement statistics")
+    @commands.check(bot_owner)
+    async def settlements(self, ctx):
+        stats = db.settlements
+        await ctx.respond(
+            f"Bet settlements: {stats['settled']} settled, {stats['retries']} "
+            f"retried after a version conflict, {stats['failed']} failed, "
+            f"{stats['missing']} skipped because the bet was gone",
+            ephemeral=True,
+        )
+
+    @owner.command(
+        name="usage", description="Shows GPT latency, token and cost telemetry"
+    )
+    @commands.check(bot_owner)
+    async def usage(self, ctx, export: bool = False):
+        if export:
+            await self.respond_with_file(
+                ctx,
+                json.dumps(gpt.telemetry.export(), indent=2),
+                "telemetry.json",
+                ephemeral=True,
+            )
+            return
+
+        def line(name: str, stats: dict) -> str:
+            return (
+                f"- {name}: {stats['calls']} calls ({stats['errors']} errors, "
+                f"{stats['cached']} cached, {stats['rejected']} rejected, "
+                f"{stats['retries']} retries, {stats['hedges']} hedges, "
+                f"{stats['fallbacks']} fallbacks), "
+                f"latency p50 {stats['latency_p50']:.2f}s "
+                f"p95 {stats['latency_p95']:.2f}s, ttfb p50 {stats['ttfb_p50']:.2f}s, "
+                f"{stats['prompt_tokens']}+{stats['completion_tokens']} tokens "
+                f"({stats['cached_tokens']} cached), ${stats['cost']:.4f} "
+                f"(saved ${stats['saved']:.4f})\n"
+            )
+
+        message = f"## GPT usage (last {gpt.telemetry.window / 3600:.0f}h)\n"
+        message += line("total", gpt.telemetry.total())
+        message += "### Commands\n"
+        for command, stats in gpt.telemetry.group("command").items():
+            message += line(command, stats)
+        message += "### Guilds\n"
+        for guild_id, stats in gpt.telemetry.group("guild_id").items():
+            guild = self.bot.get_guild(guild_id)
+            message += line(guild.name if guild else str(guild_id), stats)
+        await ctx.respond(message[0:1999], ephemeral=True)
+
+    @owner.command(name="queries", description="Shows the slowest database statements")
+    @commands.check(bot_owner)
+    async def queries(self, ctx, export: bool = False):
+        if export:
+            await self.respond_with_file(
+                ctx,
+                json.dumps(dbstats.stats.export(), indent=2),
+                "queries.json",
+                ephemeral=True,
+            )
+            return
+
+        def timings(stats: dict) -> str:
+            return (
+                f"{stats['count']} runs, avg {stats['avg'] * 1000:.1f}ms "
+                f"p95 {stats['p95'] * 1000:.1f}ms max {stats['max'] * 1000:.1f}ms"
+            )
+
+        stats = dbstats.stats
+        message = (
+            f"## Database\nPool checkouts: {timings(stats.checkouts.to_dict())}, "
+            f"{stats.errors} errors, {len(stats.slow)} recent slow queries\n"
+            "### Slowest statements\n"
+        )
+        for statement, entry in stats.slowest(5):
+            statement = " ".join(statement.split())
+            message += f"- {timings(entry.to_dict())}\n  `{statement[:150]}`\n"
+        message += "### Functions\n"
+        functions = sorted(
+            stats.functions.items(), key=lambda item: item[1].total, reverse=True
+        )
+        for name, entry in functions[:8]:
+            message += f"- {name}: {timings(entry.to_dict())}\n"
+        await ctx.respond(message[0:1999], ephemeral=True)
+
     @owner.command(name="reset", description="full reset of the database")
     @commands.check(bot_owner)
     async def reset(self, ctx, confirmation: str):
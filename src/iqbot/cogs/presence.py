@@ -1,9 +1,8 @@
 from discord import Member
 from discord.ext import commands
 from loguru import logger
-from sqlalchemy import select
 
-from iqbot.db import User, db_logger, get_session
+from iqbot import db
 
 
 class Presence(commands.Cog):
@@ -11,30 +10,20 @@ class Presence(commands.Cog):
         self.bot = bot
 
     @commands.Cog.listener()
-    @db_logger
     async def on_member_join(self, member: Member):
         logger.info(f"Member joined: {member.name} ({member.id})")
-        async with get_session() as session:
-            result = await session.execute(
-                select(User).where(User.member_id == member.id)
-            )
-            user = result.scalar_one_or_none()
-            if user:
-                user.is_present = True
-                await session.commit()
+        try:
+            await db.update_user_presence(member.guild.id, member.id, True)
+        except Exception as e:
+            logger.error(f"Error in on_member_join: {e}")
 
     @commands.Cog.listener()
-    @db_logger
     async def on_member_remove(self, member: Member):
         logger.info(f"Member left: {member.name} ({member.id})")
-        async with get_session() as session:
-            result = await session.execute(
-                select(User).where(User.member_id == member.id)
-            )
-            user = result.scalar_one_or_none()
-            if user:
-                user.is_present = False
-                await session.commit()
+        try:
+            await db.update_user_presence(member.guild.id, member.id, False)
+        except Exception as e:
+            logger.error(f"Error in on_member_remove: {e}")
 
 
 def setup(bot):
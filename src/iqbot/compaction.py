@@ -0,0 +1,78 @@
+import re
+from difflib import SequenceMatcher
+from functools import lru_cache
+
+from iqbot.config import settings
+from iqbot.tokens import TokenCounter
+
+# gpt.format_message puts the message body after this, following the
+# "[ID: ... | author]" header.
+HEADER_END = "]: "
+
+URL = re.compile(r"https?://(?:www\.)?([^/\s:?#>]+)[^\s>]*")
+CUSTOM_EMOJI = re.compile(r"<a?(:\w+:)\d+>")
+# The same one to eight characters four or more times in a row, e.g.
+# "hahahahaha", "!!!!!!!" or a line of the same emoji. Digits are left
+# alone, so that numbers like 1000000 reach the judge as written.
+REPEATED = re.compile(r"([^\s\d]{1,8}?)\1{3,}")
+BLANK_LINES = re.compile(r"\n{3,}")
+SPACES = re.compile(r"[ \t]{2,}")
+NON_WORD = re.compile(r"[\W_]+")
+DIGITS = re.compile(r"\d+")
+# The same messages are compacted and compared on every request for their
+# channel, so results are memoized, for as many messages as token counts are.
+CACHE_SIZE = settings.gpt.tokens.cache_size
+
+
+def split(formatted: str) -> tuple[str, str]:
+    """Split a formatted message into its header and body."""
+    end = formatted.find(HEADER_END)
+    if end < 0:
+        return "", formatted
+    end += len(HEADER_END)
+    return formatted[:end], formatted[end:]
+
+
+def truncate(text: str, counter: TokenCounter, max_tokens: int) -> str:
+    """Cap `text` at roughly `max_tokens`, keeping its head and tail."""
+    # A token is at least one character, so shorter texts cannot be over.
+    if len(text) <= max_tokens:
+        return text
+    tokens = counter.count(text)
+    if tokens <= max_tokens:
+        return text
+    keep = len(text) * max_tokens // tokens // 2
+    return f"{text[:keep].rstrip()} [… {tokens - max_tokens} tokens cut …] {text[-keep:].lstrip()}"
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def compact(text: str, counter: TokenCounter, max_tokens: int) -> str:
+    text = CUSTOM_EMOJI.sub(r"\1", text)
+    text = URL.sub(r"<\1>", text)
+    text = REPEATED.sub(r"\1\1\1", text)
+    text = BLANK_LINES.sub("\n\n", text)
+    text = SPACES.sub(" ", text)
+    return truncate(text.strip(), counter, max_tokens)
+
+
+def normalize(text: str) -> str:
+    return NON_WORD.sub(" ", text.lower()).strip()
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def near_duplicate(a: str, b: str, threshold: float) -> bool:
+    if a == b:
+        return True
+    # "67 million" and "68 million" say different things, however similar.
+    if DIGITS.findall(a) != DIGITS.findall(b):
+        return False
+    a, b = normalize(a), normalize(b)
+    if not a or not b:
+        return False
+    if a == b:
+        return True
+    # Upper bound of SequenceMatcher.ratio, from the lengths alone.
+    if 2 * min(len(a), len(b)) / (len(a) + len(b)) < threshold:
+        return False
+    matcher = SequenceMatcher(None, a, b)
+    return matcher.quick_ratio() >= threshold and matcher.ratio() >= threshold
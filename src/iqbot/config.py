@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import Any
+from typing import Any, Literal
 
 import tomli
 from pydantic import BaseModel
@@ -11,6 +11,26 @@ class Tokens(BaseModel):
     gpt: str
 
 
+class DatabaseCacheSettings(BaseModel):
+    enabled: bool
+    size: int
+    ttl: int
+
+
+class DatabaseSqliteSettings(BaseModel):
+    journal_mode: Literal["delete", "truncate", "persist", "memory", "wal", "off"]
+    synchronous: Literal["off", "normal", "full", "extra"]
+    busy_timeout: int
+    mmap_size: int
+    cache_size: int
+    pool_size: int
+
+
+class DatabaseTelemetrySettings(BaseModel):
+    slow_query: float
+    slow_log: int
+
+
 class DatabaseSettings(BaseModel):
     url: str
     echo: bool
@@ -20,6 +40,10 @@ class DatabaseSettings(BaseModel):
     pool_timeout: int
     backup_dir: str
     retention: int
+    settle_attempts: int
+    cache: DatabaseCacheSettings
+    sqlite: DatabaseSqliteSettings
+    telemetry: DatabaseTelemetrySettings
 
 
 class OwnerSettings(BaseModel):
@@ -51,6 +75,8 @@ class BotSettings(BaseModel):
 class GptHistorySettings(BaseModel):
     minutes: int
     messages: int
+    buffer_messages: int
+    buffer_bytes: int
 
 
 class GptTokenSettings(BaseModel):
@@ -58,13 +84,112 @@ class GptTokenSettings(BaseModel):
     overhead_max: int
     output_max: int
     prompt_max: int
+    cache_size: int
+
+
+class GptCacheSettings(BaseModel):
+    size: int
+    ttl: int
+
+
+class GptSchedulerSettings(BaseModel):
+    rpm: int
+    tpm: int
+
+
+class GptHedgeSettings(BaseModel):
+    enabled: bool
+    quantile: int
+    min_samples: int
+    delay: float
+
+
+class GptRetrySettings(BaseModel):
+    attempts: int
+    deadline: float
+    backoff_base: float
+    backoff_max: float
+    fallback_model: str
+    hedge: GptHedgeSettings
+
+
+class GptStreamSettings(BaseModel):
+    enabled: bool
+    edit_interval: float
+
+
+class GptPruningSettings(BaseModel):
+    enabled: bool
+    window: int
+
+
+class GptRouteSettings(BaseModel):
+    model: str
+    commands: list[str]
+    max_tokens: int
+    max_latency: float
+
+
+class GptRouterSettings(BaseModel):
+    enabled: bool
+    min_samples: int
+    routes: list[GptRouteSettings]
+
+
+class GptCompactionSettings(BaseModel):
+    enabled: bool
+    max_message_tokens: int
+    duplicate_threshold: float
+
+
+class GptSummarySettings(BaseModel):
+    enabled: bool
+    model: str
+    chunk_tokens: int
+    max_chunks: int
+    output_tokens: int
+
+
+class GptPromptSettings(BaseModel):
+    layout: Literal["inline", "prefix"]
+    anchor: bool
+    anchor_slack: int
+
+
+class GptPriceSettings(BaseModel):
+    input: float
+    cached_input: float
+    output: float
+
+
+class GptTelemetrySettings(BaseModel):
+    window: int
+    size: int
+    prices: dict[str, GptPriceSettings]
 
 
 class GptSettings(BaseModel):
     model: str
+    base_url: str
+    concurrency: int
+    timeout: float
     system_prompt: str
     tokens: GptTokenSettings
     history: GptHistorySettings
+    cache: GptCacheSettings
+    scheduler: GptSchedulerSettings
+    retry: GptRetrySettings
+    router: GptRouterSettings
+    stream: GptStreamSettings
+    pruning: GptPruningSettings
+    compaction: GptCompactionSettings
+    prompt: GptPromptSettings
+    summary: GptSummarySettings
+    telemetry: GptTelemetrySettings
+
+
+class BetSettings(BaseModel):
+    expiry: int
 
 
 class EloSettings(BaseModel):
@@ -77,6 +202,7 @@ class Settings(BaseSettings):
     bot: BotSettings
     gpt: GptSettings
     elo: EloSettings
+    bet: BetSettings
     tokens: Tokens
 
 
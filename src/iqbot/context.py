@@ -0,0 +1,381 @@
+from collections import deque
+from contextlib import aclosing
+from time import perf_counter
+from typing import AsyncIterator, Optional
+
+from discord import ApplicationContext, Message, Reaction
+from discord.abc import Messageable
+from discord.ext.commands import Context
+from loguru import logger
+
+from iqbot import compaction
+from iqbot.config import settings
+from iqbot.history import BufferedMessage, MessageHistory
+from iqbot.tokens import TokenCounter
+
+ContextSource = ApplicationContext | Context | Reaction | Message
+
+
+def resolve_channel(ctx: ContextSource) -> Optional[Messageable]:
+    if isinstance(ctx, (ApplicationContext, Context, Message)):
+        return ctx.channel
+    if isinstance(ctx, Reaction):
+        return ctx.message.channel
+    return None
+
+
+def resolve_guild_id(ctx: ContextSource) -> int:
+    guild = ctx.message.guild if isinstance(ctx, Reaction) else ctx.guild
+    return guild.id if guild is not None else 0
+
+
+class Conversation:
+    text: str
+    messages: list[BufferedMessage]
+    tokens: int
+    pruned_tokens: int
+    truncated: bool
+    timings: dict[str, float]
+    overflow: list[BufferedMessage]
+    overflow_tokens: int
+
+    def __init__(
+        self,
+        text: str,
+        messages: list[BufferedMessage],
+        tokens: int,
+        truncated: bool,
+        timings: dict[str, float],
+        pruned_tokens: int = 0,
+        overflow: Optional[list[BufferedMessage]] = None,
+        overflow_tokens: int = 0,
+    ) -> None:
+        self.text = text
+        self.messages = messages
+        self.tokens = tokens
+        self.pruned_tokens = pruned_tokens
+        self.truncated = truncated
+        self.timings = timings
+        self.overflow = overflow or []
+        self.overflow_tokens = overflow_tokens
+
+    def __bool__(self) -> bool:
+        return bool(self.messages)
+
+
+class ContextBuilder:
+    """Streams a channel's history, newest first, through
+    fetch -> filter -> [prune] -> [compact] -> budget and assembles the
+    surviving messages in chronological order. Each stage is an async
+    generator, so the walk stops as soon as the token budget runs out."""
+
+    history: MessageHistory
+    counter: TokenCounter
+    budget: int
+    participants: set[int]
+    anchor: int
+    remaining: int
+    overflow_remaining: int
+    overflow: list[BufferedMessage]
+    raw_chars: int
+    compact_chars: int
+    collapsed: int
+    pruned: int
+    pruned_tokens: int
+    truncated: bool
+    stages: list[str]
+    elapsed: dict[str, float]
+
+    def __init__(
+        self,
+        history: MessageHistory,
+        counter: TokenCounter,
+        budget: int,
+        participants: Optional[set[int]] = None,
+        anchor: int = 0,
+        overflow_budget: int = 0,
+    ):
+        self.history = history
+        self.counter = counter
+        self.budget = budget
+        self.participants = participants or set()
+        self.anchor = anchor
+        self.remaining = budget
+        self.overflow_remaining = overflow_budget
+        self.overflow = []
+        self.raw_chars = 0
+        self.compact_chars = 0
+        self.collapsed = 0
+        self.pruned = 0
+        self.pruned_tokens = 0
+        self.truncated = False
+        self.stages = []
+        self.elapsed = {}
+
+    def timed(
+        self, stage: str, source: AsyncIterator[BufferedMessage]
+    ) -> AsyncIterator[BufferedMessage]:
+        self.stages.append(stage)
+        self.elapsed[stage] = 0.0
+        return self.measure(stage, source)
+
+    async def measure(
+        self, stage: str, source: AsyncIterator[BufferedMessage]
+    ) -> AsyncIterator[BufferedMessage]:
+        # Measures the time spent pulling each item through `stage`, which
+        # includes every stage upstream of it; `timings` subtracts those.
+        async with aclosing(source):
+            while True:
+                start = perf_counter()
+                try:
+                    message = await anext(source)
+                except StopAsyncIteration:
+                    self.elapsed[stage] += perf_counter() - start
+                    return
+                self.elapsed[stage] += perf_counter() - start
+                yield message
+
+    async def fetch(self, channel: Messageable) -> AsyncIterator[BufferedMessage]:
+        # Past `gpt.history.messages`, messages are only read as overflow or,
+        # in an anchored build, down to the anchor; see `limit`.
+        limit = (
+            settings.gpt.history.buffer_messages
+            if self.anchor or self.overflow_remaining
+            else settings.gpt.history.messages
+        )
+        async for message in self.history.read(channel, limit):
+            yield message
+
+    async def filter(
+        self, source: AsyncIterator[BufferedMessage]
+    ) -> AsyncIterator[BufferedMessage]:
+        async for message in source:
+            if not message.bot:
+                yield message
+
+    def drop(self, message: BufferedMessage) -> None:
+        self.pruned += 1
+        self.pruned_tokens += self.counter.count_message(message, message.formatted)
+
+    async def prune(
+        self, source: AsyncIterator[BufferedMessage]
+    ) -> AsyncIterator[BufferedMessage]:
+        """Keep the participants' messages, messages they replied to or that
+        replied to them, and up to `gpt.pruning.window` messages on either
+        side of each of those."""
+        window = settings.gpt.pruning.window
+        newer: deque[BufferedMessage] = deque()
+        replied_to: set[int] = set()
+        older = 0
+
+        async for message in source:
+            if (
+                message.author_id in self.participants
+                or message.reply_author_id in self.participants
+                or message.id in replied_to
+            ):
+                while newer:
+                    yield newer.popleft()
+                if message.author_id in self.participants and message.reply_id:
+                    replied_to.add(message.reply_id)
+                older = window
+                yield message
+            elif older > 0:
+                older -= 1
+                yield message
+            else:
+                if len(newer) == window:
+                    self.drop(newer.popleft())
+                if window:
+                    newer.append(message)
+                else:
+                    self.drop(message)
+
+        for message in newer:
+            self.drop(message)
+
+    def compact_message(self, message: BufferedMessage) -> tuple[BufferedMessage, str]:
+        header, body = compaction.split(message.formatted)
+        compacted = compaction.compact(
+            body, self.counter, settings.gpt.compaction.max_message_tokens
+        )
+        self.raw_chars += len(body)
+        self.compact_chars += len(compacted)
+        if compacted == body:
+            return message, body
+        return message.with_text(header + compacted), compacted
+
+    async def compact(
+        self, source: AsyncIterator[BufferedMessage]
+    ) -> AsyncIterator[BufferedMessage]:
+        """Shorten each message (links to their domain, custom emoji to their
+        name, runs of repeated text, walls of text to their head and tail) and
+        collapse consecutive near-duplicates from the same author into the
+        newest of them."""
+        threshold = settings.gpt.compaction.duplicate_threshold
+        kept: Optional[BufferedMessage] = None
+        kept_body = ""
+        repeats = 0
+
+        async for message in source:
+            message, body = self.compact_message(message)
+            if (
+                kept is not None
+                and message.author_id == kept.author_id
+                and compaction.near_duplicate(kept_body, body, threshold)
+            ):
+                repeats += 1
+                self.collapsed += 1
+                self.compact_chars -= len(body)
+                continue
+            if kept is not None:
+                yield self.repeated(kept, repeats)
+            kept, kept_body, repeats = message, body, 0
+
+        if kept is not None:
+            yield self.repeated(kept, repeats)
+
+    def repeated(self, message: BufferedMessage, repeats: int) -> BufferedMessage:
+        if not repeats:
+            return message
+        suffix = f" [sent {repeats + 1} times]"
+        self.compact_chars += len(suffix)
+        return message.with_text(message.formatted + suffix)
+
+    async def limit(
+        self, source: AsyncIterator[BufferedMessage]
+    ) -> AsyncIterator[BufferedMessage]:
+        # Messages are kept verbatim until the budget runs out or, in an
+        # anchored build, down to the anchor, so that repeated prompts for the
+        # channel start with the same message; otherwise the newest
+        # `gpt.history.messages` are kept. An anchored window may grow by
+        # `gpt.prompt.anchor_slack` messages before the cap applies to it too.
+        # Older messages are set aside as overflow (to be summarized) until
+        # the overflow budget runs out too.
+        cap = settings.gpt.history.messages
+        if self.anchor:
+            cap += settings.gpt.prompt.anchor_slack
+        kept = 0
+        async for message in source:
+            message_tokens = self.counter.count_message(message, message.formatted)
+            if not self.truncated:
+                if message_tokens > self.remaining:
+                    logger.warning("Not enough tokens available for the message.")
+                    self.truncated = True
+                elif message.id < self.anchor or kept >= cap:
+                    self.truncated = True
+            if self.truncated:
+                if message_tokens > self.overflow_remaining:
+                    return
+                self.overflow_remaining -= message_tokens
+                self.overflow.append(message)
+                continue
+            kept += 1
+            self.remaining -= message_tokens
+            yield message
+
+    def timings(self) -> dict[str, float]:
+        timings, upstream = {}, 0.0
+        for stage in self.stages:
+            timings[stage] = max(self.elapsed[stage] - upstream, 0.0)
+            upstream = self.elapsed[stage]
+        return timings
+
+    async def build(self, channel: Messageable) -> Conversation:
+        messages: list[BufferedMessage] = []
+
+        pipeline = self.timed("fetch", self.fetch(channel))
+        pipeline = self.timed("filter", self.filter(pipeline))
+        if self.participants and settings.gpt.pruning.enabled:
+            pipeline = self.timed("prune", self.prune(pipeline))
+        if settings.gpt.compaction.enabled:
+            pipeline = self.timed("compact", self.compact(pipeline))
+        pipeline = self.timed("budget", self.limit(pipeline))
+
+        start = perf_counter()
+        async with aclosing(pipeline):
+            async for message in pipeline:
+                messages.append(message)
+        messages.reverse()
+
+        timings = self.timings()
+        timings["assemble"] = perf_counter() - start - self.elapsed["budget"]
+        conversation = Conversation(
+            text="\n".join(message.formatted for message in messages),
+            messages=messages,
+            tokens=self.budget - self.remaining,
+            truncated=self.truncated,
+            timings=timings,
+            pruned_tokens=self.pruned_tokens,
+            overflow=self.overflow[::-1],
+            overflow_tokens=sum(
+                self.counter.count_message(message, message.formatted)
+                for message in self.overflow
+            ),
+        )
+        if self.overflow:
+            logger.info(
+                f"Set aside {len(self.overflow)} older messages "
+                f"({conversation.overflow_tokens} tokens) to summarize"
+            )
+        if self.raw_chars:
+            logger.info(
+                f"Compacted messages from {self.raw_chars} to {self.compact_chars} "
+                f"characters ({self.compact_chars / self.raw_chars:.0%}), "
+                f"collapsing {self.collapsed} repeats"
+            )
+        if self.pruned:
+            logger.info(
+                f"Pruned {self.pruned} bystander messages, saving {self.pruned_tokens} tokens"
+            )
+        logger.info(
+            f"Built context of {len(conversation.messages)} messages, {conversation.tokens} tokens ("
+            + ", ".join(f"{k}={v * 1000:.1f}ms" for k, v in timings.items())
+            + ")"
+        )
+        return conversation
+
+
+def next_anchor(conversation: Conversation) -> int:
+    """The anchor for the next prompt about the same conversation: its first
+    message or, once the anchored window is full, the first of its newest
+    `gpt.history.messages`, so that later prompts have room to grow again."""
+    window = conversation.messages
+    if len(window) >= settings.gpt.history.messages + settings.gpt.prompt.anchor_slack:
+        window = window[-settings.gpt.history.messages :]
+    return window[0].id
+
+
+async def build_context(
+    ctx: ContextSource,
+    history: MessageHistory,
+    counter: TokenCounter,
+    budget: int,
+    participants: Optional[set[int]] = None,
+    anchor: int = 0,
+    overflow_budget: int = 0,
+) -> Conversation:
+    channel = resolve_channel(ctx)
+    if channel is None:
+        logger.error("Invalid context type provided.")
+        return Conversation("", [], 0, False, {})
+    return await ContextBuilder(
+        history, counter, budget, participants, anchor, overflow_budget
+    ).build(channel)
+
+
+def chunk_messages(
+    messages: list[BufferedMessage], counter: TokenCounter, chunk_tokens: int
+) -> list[list[BufferedMessage]]:
+    """Split chronological `messages` into consecutive runs of at most
+    `chunk_tokens` tokens (a longer message gets a chunk of its own)."""
+    chunks: list[list[BufferedMessage]] = []
+    size = chunk_tokens
+    for message in messages:
+        tokens = counter.count_message(message, message.formatted)
+        if size + tokens > chunk_tokens:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(message)
+        size += tokens
+    return chunks
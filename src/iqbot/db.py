@@ -1,42 +1,94 @@
 import asyncio
-import time
 from contextlib import asynccontextmanager
 from datetime import datetime
 from functools import wraps
 from pprint import pformat
-from typing import AsyncIterator, Optional, Sequence
+from time import perf_counter
+from typing import Awaitable, Callable, Optional, Sequence
 
 from loguru import logger
-from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy import BigInteger, Index, delete, event, inspect, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 from sqlalchemy.future import select
 from sqlalchemy.orm import Mapped, declarative_base, mapped_column
 
-from iqbot.config import settings
+from iqbot.cache import TTLCache
+from iqbot.config import DatabaseSettings, settings
+from iqbot.dbstats import TimedPool, instrument, stats
+from iqbot.leaderboard import Leaderboard
 
 Base = declarative_base()
 
-engine = create_async_engine(
-    settings.database.url,
-    echo=settings.database.echo,
-    pool_size=settings.database.pool_size,
-    max_overflow=settings.database.max_overflow,
-    pool_recycle=settings.database.pool_recycle,
-    pool_timeout=settings.database.pool_timeout,
-)
+
+def create_engine(database: DatabaseSettings) -> AsyncEngine:
+    if make_url(database.url).get_backend_name() != "sqlite":
+        engine = create_async_engine(
+            database.url,
+            echo=database.echo,
+            poolclass=TimedPool,
+            pool_size=database.pool_size,
+            max_overflow=database.max_overflow,
+            pool_recycle=database.pool_recycle,
+            pool_timeout=database.pool_timeout,
+            pool_pre_ping=True,
+        )
+        instrument(engine.sync_engine)
+        return engine
+
+    # A SQLite file takes one writer at a time however many connections are
+    # open, and in WAL mode readers do not wait for it, so a few long-lived
+    # connections (each an aiosqlite thread) are enough. Overflow connections
+    # would only pay for the pragmas again, and nothing recycles idle ones.
+    sqlite = database.sqlite
+    engine = create_async_engine(
+        database.url,
+        echo=database.echo,
+        poolclass=TimedPool,
+        pool_size=sqlite.pool_size,
+        max_overflow=0,
+        pool_timeout=database.pool_timeout,
+    )
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA journal_mode={sqlite.journal_mode}")
+        cursor.execute(f"PRAGMA synchronous={sqlite.synchronous}")
+        cursor.execute(f"PRAGMA busy_timeout={sqlite.busy_timeout}")
+        cursor.execute(f"PRAGMA mmap_size={sqlite.mmap_size}")
+        cursor.execute(f"PRAGMA cache_size={sqlite.cache_size}")
+        cursor.close()
+
+    instrument(engine.sync_engine)
+    return engine
+
+
+engine = create_engine(settings.database)
 
 async_session = async_sessionmaker(engine, expire_on_commit=False)
 
 
 class User(Base):
     __tablename__ = "users"
+    __table_args__ = (
+        Index("ix_users_guild_id_user_id", "guild_id", "user_id", unique=True),
+        Index("ix_users_guild_id_is_present_iq", "guild_id", "is_present", "iq"),
+    )
     __allow_unmapped__ = True
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    guild_id: Mapped[int] = mapped_column(index=True)
-    user_id: Mapped[int] = mapped_column(index=True)
+    # Discord ids are 64-bit, which SQLite's INTEGER holds but PostgreSQL's
+    # does not.
+    guild_id: Mapped[int] = mapped_column(BigInteger, index=True)
+    user_id: Mapped[int] = mapped_column(BigInteger, index=True)
     iq: Mapped[Optional[int]] = mapped_column(default=100)
     num_bets: Mapped[int] = mapped_column(default=0)
     is_present: Mapped[bool] = mapped_column(default=True)
+    # Bumped by every rating write, so a settlement can tell whether the
+    # rows it rated have changed since it read them.
+    version: Mapped[int] = mapped_column(default=0, server_default="0")
 
     def __repr__(self):
         return pformat(self.to_dict())
@@ -48,11 +100,17 @@ class User(Base):
 class Bet(Base):
     __tablename__ = "bets"
     __allow_unmapped__ = True
-    guild_id: Mapped[int] = mapped_column(index=True)
-    message_id: Mapped[int] = mapped_column(primary_key=True, index=True)
-    timestamp: Mapped[datetime] = mapped_column(default=lambda: datetime.now())
-    user_id_1: Mapped[int] = mapped_column(index=True)
-    user_id_2: Mapped[int] = mapped_column(index=True)
+    guild_id: Mapped[int] = mapped_column(BigInteger, index=True)
+    message_id: Mapped[int] = mapped_column(
+        BigInteger, primary_key=True, autoincrement=False, index=True
+    )
+    timestamp: Mapped[datetime] = mapped_column(
+        default=lambda: datetime.now(), index=True
+    )
+    user_id_1: Mapped[int] = mapped_column(BigInteger, index=True)
+    user_id_2: Mapped[int] = mapped_column(BigInteger, index=True)
+    # Where the challenge was posted, so it can be edited when it expires.
+    channel_id: Mapped[Optional[int]] = mapped_column(BigInteger)
 
     def __repr__(self):
         return pformat(self.to_dict())
@@ -61,18 +119,95 @@ class Bet(Base):
         return self.__dict__
 
 
-def db_logger(func):
+# The bot is the only writer of the users table, so rows are written through
+# to this cache on every commit and served from it without opening a session.
+# Entries are detached copies; callers get their own copy on every hit.
+users: TTLCache[tuple[int, int], User] = TTLCache(
+    settings.database.cache.size, settings.database.cache.ttl
+)
+
+
+# Per-guild rating order, loaded from the database on first use and then kept
+# up to date by every write that goes through `cache_user`. Writes made while
+# a guild is loading are held in `loading` and applied on top of the load.
+leaderboards: dict[int, Leaderboard] = {}
+loading: dict[int, dict[int, Optional[int]]] = {}
+
+
+def copy_user(user: User) -> User:
+    return User(
+        **{attr.key: getattr(user, attr.key) for attr in User.__mapper__.column_attrs}
+    )
+
+
+def cached_user(guild_id: int, user_id: int) -> Optional[User]:
+    if not settings.database.cache.enabled:
+        return None
+    user = users.get((guild_id, user_id))
+    return copy_user(user) if user is not None else None
+
+
+def cache_user(user: User) -> None:
+    """Write `user` through to the cache and the leaderboards; call once its
+    changes are committed."""
+    index_user(user.guild_id, user.user_id, user.iq if user.is_present else None)
+    if settings.database.cache.enabled:
+        users.set((user.guild_id, user.user_id), copy_user(user))
+
+
+def index_user(guild_id: int, user_id: int, iq: Optional[int]) -> None:
+    pending = loading.get(guild_id)
+    if pending is not None:
+        pending[user_id] = iq
+    board = leaderboards.get(guild_id)
+    if board is not None:
+        board.update(user_id, iq)
+
+
+def clear_caches() -> None:
+    """Forget cached users and leaderboards, e.g. after the database file
+    has been replaced."""
+    users.clear()
+    leaderboards.clear()
+
+
+class SettlementConflict(Exception):
+    """A bet could not be settled because its users' ratings kept changing
+    under it."""
+
+
+class BetNotFound(Exception):
+    """A bet could not be settled because it is no longer in the database,
+    i.e. it was already settled, declined or has expired."""
+
+
+# Outcomes of settle_bet since startup; a retry is a settlement that lost a
+# version check and rated the users again, a missing one found its bet gone.
+settlements = {"settled": 0, "retries": 0, "failed": 0, "missing": 0}
+
+
+def upsert_users():
+    """`INSERT INTO users` for the engine's dialect; both support
+    `ON CONFLICT (guild_id, user_id)` against ix_users_guild_id_user_id."""
+    dialect = postgresql if engine.dialect.name == "postgresql" else sqlite
+    return dialect.insert(User)
+
+
+def timed(func):
+    """Record the latency of every call to `func` in dbstats. Errors are
+    logged and re-raised; the statements themselves are timed by the
+    engine events."""
+
     @wraps(func)
     async def wrapper(*args, **kwargs):
-        start_time = time.time()
+        start = perf_counter()
         try:
-            result = await func(*args, **kwargs)
-            elapsed_time = time.time() - start_time
-            logger.info(f"{func.__name__} executed in {elapsed_time:.2f} seconds")
-            return result
+            return await func(*args, **kwargs)
         except Exception as e:
             logger.error(f"Error in {func.__name__}: {e}")
-            return None
+            raise
+        finally:
+            stats.function(func.__name__, perf_counter() - start)
 
     return wrapper
 
@@ -84,89 +219,201 @@ async def get_session():
         yield session
 
 
-@db_logger
+@timed
 async def add_user(user: User) -> None:
     async with get_session() as session:
         session.add(user)
         await session.commit()
+    cache_user(user)
 
 
-@db_logger
+@timed
 async def read_user(guild_id: int, user_id: int) -> Optional[User]:
+    user = cached_user(guild_id, user_id)
+    if user is not None:
+        return user
     async with get_session() as session:
         result = await session.execute(
             select(User).where(User.guild_id == guild_id, User.user_id == user_id)
         )
-        return result.scalar_one_or_none()
+        user = result.scalar_one_or_none()
+    if user is not None:
+        cache_user(user)
+    return user
 
 
-@db_logger
+@timed
 async def read_or_add_user(guild_id: int, user_id: int) -> User:
-    user = await read_user(guild_id, user_id)
-    if user is None:
-        user = User(guild_id=guild_id, user_id=user_id, iq=100)
-        await add_user(user)
-        logger.info(f"New user created: {user}")
-    else:
-        logger.info(f"Existing user found: {user}")
+    (user,) = await read_or_add_users(guild_id, [user_id])
+    logger.info(f"Read or added user: {user}")
     return user
 
 
-@db_logger
+@timed
 async def read_or_add_users(guild_id: int, user_ids: list[int]) -> list[User]:
-    async with get_session() as session:
-        stmt = select(User).where(User.guild_id == guild_id, User.user_id.in_(user_ids))
-        result = await session.execute(stmt)
-        existing_users = {user.user_id: user for user in result.scalars().all()}
-
-        missing_user_ids = set(user_ids) - existing_users.keys()
-        new_users = [
-            User(guild_id=guild_id, user_id=user_id, iq=100)
-            for user_id in missing_user_ids
-        ]
+    """The users' rows, in the order of `user_ids`, creating any that are
+    missing with a single INSERT … ON CONFLICT … RETURNING."""
+    found = {}
+    for user_id in user_ids:
+        user = cached_user(guild_id, user_id)
+        if user is not None:
+            found[user_id] = user
+    uncached_user_ids = list(
+        dict.fromkeys(user_id for user_id in user_ids if user_id not in found)
+    )
+
+    if uncached_user_ids:
+        stmt = upsert_users().values(
+            [
+                {"guild_id": guild_id, "user_id": user_id, "iq": 100}
+                for user_id in uncached_user_ids
+            ]
+        )
+        # A no-op update rather than DO NOTHING, so that existing rows are
+        # returned too.
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[User.guild_id, User.user_id],
+            set_={"user_id": stmt.excluded.user_id},
+        ).returning(User)
+        async with get_session() as session:
+            result = await session.scalars(
+                stmt, execution_options={"populate_existing": True}
+            )
+            for user in result.all():
+                found[user.user_id] = user
+            await session.commit()
 
-        session.add_all(new_users)
-        await session.commit()
-        return list(existing_users.values()) + new_users
+        for user_id in uncached_user_ids:
+            cache_user(found[user_id])
+    return [found[user_id] for user_id in user_ids]
 
 
-@db_logger
+@timed
 async def upsert_user_iq(guild_id: int, user_id: int, iq: int) -> User:
+    stmt = upsert_users().values(guild_id=guild_id, user_id=user_id, iq=iq)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[User.guild_id, User.user_id],
+        set_={"iq": stmt.excluded.iq, "version": User.version + 1},
+    ).returning(User)
     async with get_session() as session:
-        stmt = select(User).where(User.user_id == user_id, User.guild_id == guild_id)
-        result = await session.execute(stmt)
-        user = result.scalar_one_or_none()
-
-        if user:
-            user.iq = iq
-        else:
-            user = User(user_id=user_id, guild_id=guild_id, iq=iq)
-            session.add(user)
-
+        result = await session.scalars(
+            stmt, execution_options={"populate_existing": True}
+        )
+        user = result.one()
         await session.commit()
+    cache_user(user)
     return user
 
 
-async def read_top_iqs(guild_id: int) -> AsyncIterator[User]:
+@timed
+async def update_user_presence(
+    guild_id: int, user_id: int, is_present: bool
+) -> Optional[User]:
+    stmt = (
+        update(User)
+        .where(User.guild_id == guild_id, User.user_id == user_id)
+        .values(is_present=is_present)
+        .returning(User)
+    )
     async with get_session() as session:
-        stmt = select(User).where(User.guild_id == guild_id, User.is_present)
-        stmt = stmt.order_by(User.iq.desc(), User.user_id.asc())
-        result = await session.stream(stmt)
-        async for user in result.scalars():
-            yield user
+        result = await session.scalars(
+            stmt, execution_options={"populate_existing": True}
+        )
+        user = result.one_or_none()
+        await session.commit()
+    if user is not None:
+        cache_user(user)
+    return user
 
 
-async def read_bottom_iqs(guild_id: int) -> AsyncIterator[User]:
-    async with get_session() as session:
-        stmt = select(User).where(User.guild_id == guild_id, User.is_present)
-        stmt = stmt.order_by(User.iq.asc(), User.user_id.asc())
-        result = await session.stream(stmt)
-        async for user in result.scalars():
-            yield user
+@timed
+async def read_leaderboard(guild_id: int) -> Leaderboard:
+    board = leaderboards.get(guild_id)
+    if board is not None:
+        return board
+
+    pending = loading.setdefault(guild_id, {})
+    try:
+        async with get_session() as session:
+            stmt = select(User.user_id, User.iq).where(
+                User.guild_id == guild_id, User.is_present, User.iq.is_not(None)
+            )
+            result = await session.execute(stmt)
+            board = Leaderboard(result.tuples().all())
+    finally:
+        loading.pop(guild_id, None)
+    for user_id, iq in pending.items():
+        board.update(user_id, iq)
+    logger.info(f"Loaded leaderboard for guild {guild_id}: {len(board)} users")
+    return leaderboards.setdefault(guild_id, board)
+
+
+@timed
+async def settle_bet(
+    guild_id: int,
+    user_id_1: int,
+    user_id_2: int,
+    rate: Callable[[User, User], Awaitable[tuple[User, User]]],
+    message_id: Optional[int] = None,
+) -> tuple[tuple[User, User], tuple[User, User]]:
+    """Write `rate(user1, user2)` to both users' rows and delete the bet
+    `message_id`, in one transaction, returning the users before and after.
+
+    The bet is deleted first; if it is already gone, nothing is written and
+    BetNotFound is raised, so a bet is settled at most once. Each row is
+    only updated if its version is still the one that was rated. Otherwise
+    both users are read again and re-rated, up to
+    `database.settle_attempts` times, before SettlementConflict is raised."""
+    user1, user2 = await read_or_add_users(guild_id, [user_id_1, user_id_2])
+    for attempt in range(settings.database.settle_attempts):
+        before = (copy_user(user1), copy_user(user2))
+        after = await rate(copy_user(user1), copy_user(user2))
+        async with get_session() as session:
+            if message_id is not None:
+                result = await session.execute(
+                    delete(Bet).where(Bet.message_id == message_id)
+                )
+                if not result.rowcount:
+                    await session.rollback()
+                    settlements["missing"] += 1
+                    raise BetNotFound(f"Bet {message_id} is no longer pending")
+            updated = 0
+            for old, new in zip(before, after):
+                result = await session.execute(
+                    update(User)
+                    .where(User.id == old.id, User.version == old.version)
+                    .values(iq=new.iq, num_bets=new.num_bets, version=old.version + 1)
+                )
+                updated += result.rowcount
+            if updated == len(after):
+                await session.commit()
+                for user in after:
+                    user.version += 1
+                    cache_user(user)
+                settlements["settled"] += 1
+                return before, after
+            await session.rollback()
+
+        settlements["retries"] += 1
+        logger.warning(
+            f"Settlement of {user_id_1} vs {user_id_2} in guild {guild_id} lost a "
+            f"version check on attempt {attempt + 1}, re-reading both users"
+        )
+        users.pop((guild_id, user_id_1))
+        users.pop((guild_id, user_id_2))
+        user1, user2 = await read_or_add_users(guild_id, [user_id_1, user_id_2])
 
+    settlements["failed"] += 1
+    raise SettlementConflict(
+        f"Could not settle {user_id_1} vs {user_id_2} in guild {guild_id} after "
+        f"{settings.database.settle_attempts} attempts"
+    )
 
-@db_logger
+
+@timed
 async def remove_user(guild_id: int, user_id: int) -> None:
+    users.pop((guild_id, user_id))
+    index_user(guild_id, user_id, None)
     async with get_session() as session:
         stmt = select(User).where(User.user_id == user_id, User.guild_id == guild_id)
         result = await session.execute(stmt)
@@ -180,14 +427,45 @@ async def remove_user(guild_id: int, user_id: int) -> None:
             logger.warning(f"User {user_id} not found in the database")
 
 
-@db_logger
+@timed
 async def add_bet(bet: Bet) -> None:
     async with get_session() as session:
         session.add(bet)
         await session.commit()
 
 
-@db_logger
+@timed
+async def remove_bet(message_id: int) -> Optional[Bet]:
+    """Delete the bet and return it, or None if it was already gone."""
+    async with get_session() as session:
+        result = await session.scalars(
+            delete(Bet).where(Bet.message_id == message_id).returning(Bet)
+        )
+        bet = result.one_or_none()
+        await session.commit()
+    return bet
+
+
+@timed
+async def remove_expired_bets(before: datetime) -> Sequence[Bet]:
+    """Delete the bets made before `before` and return them."""
+    async with get_session() as session:
+        result = await session.scalars(
+            delete(Bet).where(Bet.timestamp < before).returning(Bet)
+        )
+        bets = result.all()
+        await session.commit()
+    return bets
+
+
+@timed
+async def read_bets() -> Sequence[Bet]:
+    async with get_session() as session:
+        result = await session.scalars(select(Bet))
+        return result.all()
+
+
+@timed
 async def read_user_bets(user_id: int) -> Sequence[Bet]:
     async with get_session() as session:
         stmt = select(Bet).where(
@@ -198,7 +476,7 @@ async def read_user_bets(user_id: int) -> Sequence[Bet]:
     return bets
 
 
-@db_logger
+@timed
 async def read_bet(message_id) -> Optional[Bet]:
     async with get_session() as session:
         stmt = select(Bet).where(Bet.message_id == message_id)
@@ -207,7 +485,22 @@ async def read_bet(message_id) -> Optional[Bet]:
     return bet
 
 
+async def create_schema() -> bool:
+    """Create the tables if the database does not have them yet, and return
+    whether it did. Disposes of the engine's connections afterwards, since
+    they belong to the event loop this ran in."""
+    try:
+        async with engine.begin() as conn:
+            if await conn.run_sync(lambda c: inspect(c).has_table(User.__tablename__)):
+                return False
+            await conn.run_sync(Base.metadata.create_all)
+            return True
+    finally:
+        await engine.dispose()
+
+
 async def async_main():
+    clear_caches()
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.drop_all)
     async with engine.begin() as conn:
@@ -0,0 +1,192 @@
+from collections import deque
+from itertools import groupby
+from time import perf_counter, time
+from typing import Any
+
+from loguru import logger
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from iqbot.config import settings
+
+# Upper bounds, in seconds, of the statement and checkout histogram buckets;
+# milliseconds matter here, unlike for the GPT calls in telemetry.
+QUERY_BUCKETS = (
+    0.001,
+    0.002,
+    0.005,
+    0.01,
+    0.02,
+    0.05,
+    0.1,
+    0.2,
+    0.5,
+    1.0,
+    float("inf"),
+)
+
+
+def shape(parameters: Any) -> str:
+    """The types of a statement's bound parameters, without their values,
+    e.g. `(int x 2, str)` or `3 x {guild_id: int, user_id: int}`."""
+    if (
+        isinstance(parameters, (list, tuple))
+        and parameters
+        and all(isinstance(p, (dict, list, tuple)) for p in parameters)
+    ):
+        return f"{len(parameters)} x {shape(parameters[0])}"
+    if isinstance(parameters, dict):
+        fields = ", ".join(f"{k}: {type(v).__name__}" for k, v in parameters.items())
+        return f"{{{fields}}}"
+    if isinstance(parameters, (list, tuple)):
+        # A multi-row INSERT binds the same types over and over.
+        runs = [
+            (name, len(list(run)))
+            for name, run in groupby(type(p).__name__ for p in parameters)
+        ]
+        return f"({', '.join(n if k == 1 else f'{n} x {k}' for n, k in runs)})"
+    return type(parameters).__name__
+
+
+class Timings:
+    """Count, total, maximum and histogram of a series of durations."""
+
+    __slots__ = ("count", "total", "max", "histogram")
+
+    count: int
+    total: float
+    max: float
+    histogram: list[int]
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.histogram = [0] * len(QUERY_BUCKETS)
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.histogram[
+            next(i for i, b in enumerate(QUERY_BUCKETS) if seconds <= b)
+        ] += 1
+
+    def percentile(self, q: int) -> float:
+        """Upper bound of the bucket holding the `q`th percentile, capped at
+        the largest duration seen."""
+        seen = 0
+        for bound, count in zip(QUERY_BUCKETS, self.histogram):
+            seen += count
+            if seen * 100 >= self.count * q:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "count": self.count,
+            "avg": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "max": self.max,
+            "histogram": {
+                str(bound): count for bound, count in zip(QUERY_BUCKETS, self.histogram)
+            },
+        }
+
+
+class QueryStats:
+    """Timings of every statement the engine runs, of the db functions and
+    of waits for a pooled connection, plus the most recent slow queries."""
+
+    statements: dict[str, Timings]
+    functions: dict[str, Timings]
+    checkouts: Timings
+    slow: deque[dict[str, Any]]
+    errors: int
+
+    def __init__(self, slow_log: int) -> None:
+        self.statements = {}
+        self.functions = {}
+        self.checkouts = Timings()
+        self.slow = deque(maxlen=slow_log)
+        self.errors = 0
+
+    def statement(
+        self, statement: str, parameters: Any, executemany: bool, seconds: float
+    ) -> None:
+        self.statements.setdefault(statement, Timings()).add(seconds)
+        if seconds < settings.database.telemetry.slow_query:
+            return
+        params = shape(parameters)
+        self.slow.append(
+            {
+                "timestamp": time(),
+                "seconds": seconds,
+                "statement": statement,
+                "parameters": params,
+                "executemany": executemany,
+            }
+        )
+        logger.warning(
+            f"Slow query ({seconds * 1000:.1f} ms, parameters {params}): "
+            f"{' '.join(statement.split())}"
+        )
+
+    def function(self, name: str, seconds: float) -> None:
+        self.functions.setdefault(name, Timings()).add(seconds)
+
+    def slowest(self, n: int) -> list[tuple[str, Timings]]:
+        """The `n` statements with the highest maximum duration."""
+        return sorted(
+            self.statements.items(), key=lambda item: item[1].max, reverse=True
+        )[:n]
+
+    def export(self) -> dict[str, Any]:
+        return {
+            "exported_at": time(),
+            "errors": self.errors,
+            "checkouts": self.checkouts.to_dict(),
+            "functions": {k: v.to_dict() for k, v in self.functions.items()},
+            "statements": {k: v.to_dict() for k, v in self.statements.items()},
+            "slow": list(self.slow),
+        }
+
+
+stats = QueryStats(settings.database.telemetry.slow_log)
+
+
+class TimedPool(AsyncAdaptedQueuePool):
+    """The async engines' default pool, also timing how long each checkout
+    waits for a connection."""
+
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            stats.checkouts.add(perf_counter() - start)
+
+
+def instrument(engine: Engine) -> None:
+    """Time every statement run on `engine` (the sync engine behind an
+    AsyncEngine), including from sessions opened outside of db.py."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(
+        conn, cursor, statement, parameters, context, executemany
+    ):
+        conn.info.setdefault("query_start", []).append(perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info["query_start"].pop()
+        stats.statement(statement, parameters, executemany, perf_counter() - start)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        stats.errors += 1
+        conn = context.connection
+        if conn is not None and conn.info.get("query_start"):
+            conn.info["query_start"].pop()
@@ -1,30 +1,103 @@
-from datetime import datetime, timedelta
+import asyncio
+import hashlib
+from contextlib import AsyncExitStack, aclosing
 from enum import Enum
+from functools import lru_cache
+from time import perf_counter
+from typing import AsyncIterator, Callable, Optional
 
-import tiktoken
-from discord import ApplicationContext, Message, Reaction
-from discord.ext.commands import Context
+from discord import Message
 from loguru import logger
-from openai import OpenAI
+from openai import APITimeoutError, AsyncOpenAI, RateLimitError
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
 
+from iqbot import context, resilience, router, tokens
+from iqbot.cache import TTLCache
 from iqbot.config import settings
-
-client = OpenAI(api_key=settings.tokens.gpt)
+from iqbot.context import ContextSource, Conversation
+from iqbot.history import BufferedMessage, MessageHistory
+from iqbot.scheduler import Scheduler
+from iqbot.telemetry import Call, Telemetry
+
+# Retries are handled by resilience.retrying, and rate limits by the
+# scheduler, which knows about the other requests waiting for the same budget,
+# rather than by the SDK.
+client = AsyncOpenAI(
+    api_key=settings.tokens.gpt,
+    base_url=settings.gpt.base_url,
+    timeout=settings.gpt.timeout,
+    max_retries=0,
+)
+scheduler = Scheduler(
+    settings.gpt.scheduler.rpm,
+    settings.gpt.scheduler.tpm,
+    settings.gpt.concurrency,
+)
+
+counter = tokens.get_counter(settings.gpt.model)
+verdicts: TTLCache[str, str] = TTLCache(settings.gpt.cache.size, settings.gpt.cache.ttl)
+summaries: TTLCache[str, str] = TTLCache(
+    settings.gpt.cache.size, settings.gpt.cache.ttl
+)
+telemetry = Telemetry(settings.gpt.telemetry.window, settings.gpt.telemetry.size)
+# Oldest verbatim message of the last prompt built per channel and
+# participants; an anchor is useless once its message has aged out of the
+# history window.
+anchors: TTLCache[tuple[int, tuple[int, ...]], int] = TTLCache(
+    settings.gpt.cache.size, settings.gpt.history.minutes * 60
+)
+
+PROMPT_TEMPLATE = "Based on the following conversation: \n\n{conversation}\n\n please answer: {command_prompt}."
+PROMPT_OVERHEAD = PROMPT_TEMPLATE.format(conversation="", command_prompt="")
+# The prefix layout sends the conversation and the question as separate
+# messages, so everything up to the question can be served from the
+# provider's prompt cache when a channel is judged again.
+CONVERSATION_TEMPLATE = "Based on the following conversation:\n\n{conversation}"
+QUESTION_TEMPLATE = "Please answer: {command_prompt}."
+PREFIX_OVERHEAD = CONVERSATION_TEMPLATE.format(
+    conversation=""
+) + QUESTION_TEMPLATE.format(command_prompt="")
+NO_CONVERSATION = "No conversation history available to generate a response."
+SUMMARY_PROMPT = (
+    "You are given one part of a longer chronological conversation. Summarize it "
+    "for a judge who will later decide who won an argument in the conversation. "
+    "For each user, keep their claims, the evidence and reasoning offered for "
+    "them, what they conceded and what they left unanswered. Refer to users by "
+    "their exact usernames. Do not judge the argument yourself. Be concise."
+)
+SUMMARY_TEMPLATE = "Summary of earlier parts of the conversation:\n\n{summaries}\n\nRecent messages:\n\n{conversation}"
+SUMMARY_PART = "[Part {index} of {count}]\n{summary}"
 
 
 def count_tokens(input: str) -> int:
-    encoding = tiktoken.encoding_for_model(settings.gpt.model)
-    return len(encoding.encode(input))
+    return counter.count(input)
 
 
-def available_tokens(input: str) -> int:
-    return (
-        settings.gpt.tokens.limit
-        - settings.gpt.tokens.overhead_max
-        - settings.gpt.tokens.prompt_max
-        - settings.gpt.tokens.output_max
-        - count_tokens(input)
-    )
+def prompt_overhead() -> str:
+    if settings.gpt.prompt.layout == "prefix":
+        return PREFIX_OVERHEAD
+    return PROMPT_OVERHEAD
+
+
+def summary_reserve() -> int:
+    """Tokens kept free in the context budget for overflow summaries."""
+    summary = settings.gpt.summary
+    if not summary.enabled:
+        return 0
+    return summary_tokens(summary.max_chunks, summary.output_tokens)
+
+
+@lru_cache(maxsize=None)
+def summary_tokens(max_chunks: int, output_tokens: int) -> int:
+    # The templates are fixed, so they are only tokenized once per setting.
+    part = SUMMARY_PART.format(index=max_chunks, count=max_chunks, summary="")
+    return counter.count(
+        SUMMARY_TEMPLATE.format(summaries="", conversation="")
+    ) + max_chunks * (output_tokens + counter.count(part) + 2)
+
+
+def context_budget(system_prompt: str = settings.gpt.system_prompt) -> int:
+    return counter.budget(system_prompt, prompt_overhead()) - summary_reserve()
 
 
 class Role(str, Enum):
@@ -45,6 +118,20 @@ class ChatMessage:
         return self.__dict__
 
 
+def attachment_placeholders(message: Message) -> list[str]:
+    placeholders = []
+    for attachment in message.attachments:
+        kind = (attachment.content_type or "").split("/")[0]
+        placeholders.append(
+            f"[{kind if kind in ('image', 'video', 'audio') else 'file'}]"
+        )
+    for embed in message.embeds:
+        # Link previews repeat a URL that is already in the content.
+        if not embed.url or embed.url not in message.content:
+            placeholders.append("[embed]")
+    return placeholders
+
+
 def format_message(message: Message) -> str:
     reply_id = None
     if (
@@ -55,124 +142,46 @@ def format_message(message: Message) -> str:
         reply_id = message.reference.resolved.id
     id = message.id
     author = message.author.name
+    content = " ".join([message.content, *attachment_placeholders(message)]).strip()
     if not reply_id:
-        return f"[ID: {id} | {author}]: {message.content}"
+        return f"[ID: {id} | {author}]: {content}"
     else:
-        return f"[ID: {id} | {author} replying to {reply_id}]: {message.content}"
-
-
-async def read_context(ctx: ApplicationContext | Reaction | Message) -> str:
-    messages = []
-    context_tokens = available_tokens("")
-    if isinstance(ctx, ApplicationContext):
-        reference_time = datetime.now()
-        channel = ctx.channel
-    elif isinstance(ctx, Message):
-        reference_time = ctx.created_at
-        channel = ctx.channel
-    elif isinstance(ctx, Reaction):
-        reference_time = ctx.message.created_at
-        channel = ctx.message.channel
-    else:
-        logger.error("Invalid context type provided.")
-        return ""
-
-    async for message in channel.history(
-        before=datetime.now(),
-        after=datetime.now() - timedelta(minutes=settings.gpt.history.minutes),
-        limit=settings.gpt.history.messages,
-        oldest_first=False,
-    ):
-        if message.author.bot:
-            continue
-
-        formatted_message = format_message(message)
-        message_tokens = count_tokens(formatted_message)
-
-        if context_tokens - message_tokens < 0:
-            logger.warning("Not enough tokens available for the message.")
-            break
-
-        context_tokens -= message_tokens
-        messages.append(formatted_message)
-
-    return "\n".join(messages[::-1])
-
-
-async def read_current_context(ctx: ApplicationContext) -> str:
-    messages = []
-    context_tokens = available_tokens("")
-    async for message in ctx.channel.history(
-        before=datetime.now(),
-        after=datetime.now() - timedelta(minutes=settings.gpt.history.minutes),
-        limit=settings.gpt.history.messages,
-        oldest_first=False,
-    ):
-        if message.author.bot:
-            continue
-
-        formatted_message = format_message(message)
-        message_tokens = count_tokens(formatted_message)
-
-        if context_tokens - message_tokens < 0:
-            logger.warning("Not enough tokens available for the message.")
-            break
-
-        context_tokens -= message_tokens
-        messages.append(formatted_message)
-
-    return "\n".join(messages[::-1])
-
-
-async def read_message_context(msg: Message) -> str:
-    messages = []
-    context_tokens = available_tokens("")
-    async for message in msg.channel.history(
-        before=msg.created_at,
-        after=msg.created_at - timedelta(minutes=settings.gpt.history.minutes),
-        limit=settings.gpt.history.messages,
-        oldest_first=False,
-    ):
-        if message.author.bot:
-            continue
-
-        formatted_message = format_message(message)
-        message_tokens = count_tokens(formatted_message)
-
-        if context_tokens - message_tokens < 0:
-            logger.warning("Not enough tokens available for the message.")
-            break
-
-        context_tokens -= message_tokens
-        messages.append(formatted_message)
-
-    return "\n".join(messages[::-1])
-
-
-async def read_reaction_context(reaction: Reaction) -> str:
-    messages = []
-    context_tokens = available_tokens("")
-    async for message in reaction.message.channel.history(
-        before=reaction.message.created_at,
-        after=reaction.message.created_at
-        - timedelta(minutes=settings.gpt.history.minutes),
-        limit=settings.gpt.history.messages,
-        oldest_first=False,
-    ):
-        if message.author.bot:
-            continue
-
-        formatted_message = format_message(message)
-        message_tokens = count_tokens(formatted_message)
-
-        if context_tokens - message_tokens < 0:
-            logger.warning("Not enough tokens available for the message.")
-            break
+        return f"[ID: {id} | {author} replying to {reply_id}]: {content}"
+
+
+buffers = MessageHistory(
+    [entry.channel for entry in settings.bot.whitelist],
+    format_message,
+    settings.gpt.history.buffer_messages,
+    settings.gpt.history.buffer_bytes,
+)
+
+
+async def build_context(
+    ctx: ContextSource,
+    system_prompt: str = settings.gpt.system_prompt,
+    participants: Optional[list[int]] = None,
+    anchor: int = 0,
+) -> Conversation:
+    return await context.build_context(
+        ctx,
+        buffers,
+        counter,
+        context_budget(system_prompt),
+        set(participants) if participants else None,
+        anchor,
+        (
+            settings.gpt.summary.max_chunks * settings.gpt.summary.chunk_tokens
+            if settings.gpt.summary.enabled
+            else 0
+        ),
+    )
 
-        context_tokens -= message_tokens
-        messages.append(formatted_message)
 
-    return "\n".join(messages[::-1])
+async def read_context(
+    ctx: ContextSource, system_prompt: str = settings.gpt.system_prompt
+) -> str:
+    return (await build_context(ctx, system_prompt)).text
 
 
 async def build_prompt(
@@ -187,43 +196,447 @@ async def build_prompt(
                 content=system_prompt.strip(),
             )
         )
+    if settings.gpt.prompt.layout == "prefix":
+        messages.append(
+            ChatMessage(
+                role=Role.USER,
+                content=CONVERSATION_TEMPLATE.format(conversation=conversation),
+            )
+        )
+        messages.append(
+            ChatMessage(
+                role=Role.USER,
+                content=QUESTION_TEMPLATE.format(command_prompt=command_prompt),
+            )
+        )
+        return messages
     messages.append(
         ChatMessage(
             role=Role.USER,
-            content=f"Based on the following conversation: \n\n{conversation}\n\n please answer: {command_prompt}.",
+            content=PROMPT_TEMPLATE.format(
+                conversation=conversation, command_prompt=command_prompt
+            ),
         )
     )
     return messages
 
 
-async def send_prompt(
-    ctx: ApplicationContext | Reaction, system_prompt: str, command_prompt: str
-) -> str:
+def message_key(messages: list[BufferedMessage], *parts: str) -> str:
+    digest = hashlib.sha256()
+    for message in messages:
+        edited = message.edited_at.timestamp() if message.edited_at else 0
+        digest.update(f"{message.id}:{edited};".encode())
+    for part in parts:
+        digest.update(b"\0" + part.encode())
+    return digest.hexdigest()
 
-    conversation = await read_context(ctx)
 
-    if not conversation:
-        logger.warning("No conversation history found.")
-        return "No conversation history available to generate a response."
+def verdict_key(
+    conversation: Conversation, system_prompt: str, command_prompt: str, model: str
+) -> str:
+    return message_key(
+        conversation.overflow + conversation.messages,
+        system_prompt,
+        command_prompt,
+        model,
+    )
 
-    messages = await build_prompt(conversation, system_prompt, command_prompt)
+
+def retry_after(error: RateLimitError, attempt: int) -> float:
+    headers = error.response.headers
     try:
-        response = client.chat.completions.create(
-            model=settings.gpt.model,
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return resilience.backoff(attempt)
+
+
+def hedge_delay(model: str, field: str) -> Optional[float]:
+    hedge = settings.gpt.retry.hedge
+    if not hedge.enabled:
+        return None
+    observed = telemetry.percentile(model, field, hedge.quantile, hedge.min_samples)
+    return observed if observed is not None else hedge.delay
+
+
+def on_retry(call: Call, error: BaseException, attempt: int) -> Optional[float]:
+    call.retry()
+    if isinstance(error, RateLimitError):
+        # Pausing the scheduler holds back every queued request, not just
+        # this one, so there is no need to sleep as well.
+        scheduler.backoff(retry_after(error, attempt))
+        return 0.0
+    return None
+
+
+async def complete(
+    call: Call,
+    tokens: int,
+    messages: list[ChatMessage],
+    max_tokens: Optional[int] = None,
+) -> ChatCompletion:
+    async def attempt(model: str, hedged: bool) -> ChatCompletion:
+        async with scheduler.slot(call.guild_id, tokens):
+            if not hedged:
+                call.begin()
+            response = await resilience.deadline(
+                client.chat.completions.create(
+                    model=model,
+                    messages=[message.to_dict() for message in messages],  # type: ignore
+                    max_tokens=max_tokens or settings.gpt.tokens.output_max,
+                    timeout=settings.gpt.timeout,
+                )
+            )
+            call.usage(response.usage)
+            return response
+
+    return await resilience.retrying(
+        router.model_chain(call.model),
+        attempt,
+        lambda model: hedge_delay(model, "latency"),
+        lambda error, n: on_retry(call, error, n),
+        call.hedge,
+        call.fall_back,
+    )
+
+
+class OpenStream:
+    """A streamed response that has produced its first chunk of text, still
+    holding its scheduler slot."""
+
+    stack: AsyncExitStack
+    chunks: AsyncIterator[ChatCompletionChunk]
+    first: str
+
+    def __init__(
+        self, stack: AsyncExitStack, chunks: AsyncIterator[ChatCompletionChunk]
+    ) -> None:
+        self.stack = stack
+        self.chunks = chunks
+        self.first = ""
+
+    async def close(self) -> None:
+        await self.stack.aclose()
+
+
+async def open_stream(
+    call: Call, tokens: int, messages: list[ChatMessage], model: str, hedged: bool
+) -> OpenStream:
+    async def first_chunk(stack: AsyncExitStack) -> OpenStream:
+        stream = await client.chat.completions.create(
+            model=model,
             messages=[message.to_dict() for message in messages],  # type: ignore
             max_tokens=settings.gpt.tokens.output_max,
+            timeout=settings.gpt.timeout,
+            stream=True,
+            stream_options={"include_usage": True},
         )
-        logger.info(f"GPT response: {response.choices[0].message.content}")
-        return (
-            response.choices[0].message.content
-            if response.choices[0].message.content
-            else "No response from GPT"
+        await stack.enter_async_context(stream)
+        opened = OpenStream(stack, aiter(stream))
+        async for chunk in opened.chunks:
+            call.usage(chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                call.first_byte()
+                opened.first = chunk.choices[0].delta.content
+                break
+        return opened
+
+    stack = AsyncExitStack()
+    try:
+        await stack.enter_async_context(scheduler.slot(call.guild_id, tokens))
+        if not hedged:
+            call.begin()
+        # Once text has been shown it cannot be taken back, so the deadline,
+        # retries and hedging only cover the wait for the first token.
+        return await resilience.deadline(first_chunk(stack))
+    except BaseException:
+        await stack.aclose()
+        raise
+
+
+async def stream_completion(
+    call: Call, tokens: int, messages: list[ChatMessage]
+) -> AsyncIterator[str]:
+    opened = await resilience.retrying(
+        router.model_chain(call.model),
+        lambda model, hedged: open_stream(call, tokens, messages, model, hedged),
+        lambda model: hedge_delay(model, "ttfb"),
+        lambda error, n: on_retry(call, error, n),
+        call.hedge,
+        call.fall_back,
+        OpenStream.close,
+    )
+    async with opened.stack:
+        if opened.first:
+            yield opened.first
+        async for chunk in opened.chunks:
+            # The usage chunk comes last, with no choices.
+            call.usage(chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+async def summarize_chunk(guild_id: int, chunk: list[BufferedMessage]) -> str:
+    summary = settings.gpt.summary
+    key = message_key(chunk, SUMMARY_PROMPT, summary.model)
+    cached = summaries.get(key)
+    if cached is not None:
+        return cached
+
+    text = "\n".join(message.formatted for message in chunk)
+    tokens = (
+        sum(counter.count_message(message, message.formatted) for message in chunk)
+        + counter.count(SUMMARY_PROMPT)
+        + summary.output_tokens
+    )
+    call = Call(guild_id, "summary", summary.model)
+    try:
+        response = await complete(
+            call,
+            tokens,
+            [ChatMessage(Role.SYSTEM, SUMMARY_PROMPT), ChatMessage(Role.USER, text)],
+            summary.output_tokens,
         )
-    except Exception as e:
-        logger.error(f"Error occurred in send_prompt: {e}")
-        return (
-            "An error occurred while processing your request. Please try again later."
+    except Exception:
+        telemetry.record(call, "error")
+        raise
+    telemetry.record(call, "ok")
+    result = response.choices[0].message.content or ""
+    summaries.set(key, result)
+    return result
+
+
+async def summarize_overflow(guild_id: int, conversation: Conversation) -> str:
+    """Summarize the messages that did not fit the budget, chunk by chunk and
+    concurrently, newest chunks first if there are too many."""
+    summary = settings.gpt.summary
+    chunks = context.chunk_messages(
+        conversation.overflow, counter, summary.chunk_tokens
+    )[-summary.max_chunks :]
+    start = perf_counter()
+    parts = await asyncio.gather(
+        *(summarize_chunk(guild_id, chunk) for chunk in chunks)
+    )
+    logger.info(
+        f"Summarized {sum(len(chunk) for chunk in chunks)} overflow messages in "
+        f"{len(chunks)} chunks in {perf_counter() - start:.2f}s"
+    )
+    return "\n\n".join(
+        SUMMARY_PART.format(index=i, count=len(parts), summary=part.strip())
+        for i, part in enumerate(parts, 1)
+    )
+
+
+class PromptRequest:
+    guild_id: int
+    model: str
+    key: str
+    messages: list[ChatMessage]
+    tokens: int
+
+    def __init__(
+        self,
+        guild_id: int,
+        model: str,
+        key: str,
+        messages: list[ChatMessage],
+        tokens: int,
+    ) -> None:
+        self.guild_id = guild_id
+        self.model = model
+        self.key = key
+        self.messages = messages
+        self.tokens = tokens
+
+    def models(self, validate: Optional[Callable[[str], bool]]) -> list[str]:
+        """The routed model, then the primary model if answers need
+        validating and the routed model is a different one."""
+        if validate is None or self.model == settings.gpt.model:
+            return [self.model]
+        return [self.model, settings.gpt.model]
+
+
+async def prepare_prompt(
+    ctx: ContextSource,
+    system_prompt: str,
+    command_prompt: str,
+    participants: Optional[list[int]] = None,
+    command: str = "prompt",
+) -> Optional[PromptRequest]:
+    anchor_key = (
+        getattr(context.resolve_channel(ctx), "id", 0),
+        tuple(sorted(participants or [])),
+    )
+    anchor = 0
+    if settings.gpt.prompt.layout == "prefix" and settings.gpt.prompt.anchor:
+        anchor = anchors.get(anchor_key) or 0
+    conversation = await build_context(ctx, system_prompt, participants, anchor)
+
+    if not conversation:
+        logger.warning("No conversation history found.")
+        return None
+    anchors.set(anchor_key, context.next_anchor(conversation))
+
+    guild_id = context.resolve_guild_id(ctx)
+    text = conversation.text
+    tokens = conversation.tokens + counter.fixed_cost(system_prompt, prompt_overhead())
+    if conversation.overflow:
+        try:
+            summary = await summarize_overflow(guild_id, conversation)
+            text = SUMMARY_TEMPLATE.format(summaries=summary, conversation=text)
+            tokens += counter.count(
+                SUMMARY_TEMPLATE.format(summaries=summary, conversation="")
+            )
+        except Exception as e:
+            logger.error(f"Failed to summarize overflow, judging recent messages: {e}")
+
+    messages = await build_prompt(text, system_prompt, command_prompt)
+    model = router.choose_model(command, tokens, telemetry)
+    return PromptRequest(
+        guild_id=guild_id,
+        model=model,
+        key=verdict_key(conversation, system_prompt, command_prompt, model),
+        messages=messages,
+        tokens=tokens,
+    )
+
+
+def cached_verdict(request: PromptRequest) -> Optional[str]:
+    cached = verdicts.get(request.key)
+    if cached is not None:
+        logger.info(
+            f"Verdict cache hit ({verdicts.hits} hits, {verdicts.misses} misses)"
         )
+    return cached
+
+
+def error_response(error: Exception) -> str:
+    if isinstance(error, (APITimeoutError, asyncio.TimeoutError)):
+        logger.error(f"GPT request timed out: {error!r}")
+        return "GPT took too long to respond. Please try again later."
+    if isinstance(error, RateLimitError):
+        logger.error(f"GPT rate limit exceeded: {error}")
+        return "GPT is rate limited right now. Please try again in a minute."
+    logger.error(f"Error occurred while querying GPT: {error}")
+    return "An error occurred while processing your request. Please try again later."
+
+
+async def send_prompt(
+    ctx: ContextSource,
+    system_prompt: str,
+    command_prompt: str,
+    participants: Optional[list[int]] = None,
+    command: str = "prompt",
+    validate: Optional[Callable[[str], bool]] = None,
+) -> str:
+    """Ask GPT `command_prompt` about the conversation in `ctx`. When the
+    request is routed to a cheaper model, answers failing `validate` are
+    asked again of the primary model."""
+    request = await prepare_prompt(
+        ctx, system_prompt, command_prompt, participants, command
+    )
+    if request is None:
+        return NO_CONVERSATION
+
+    cached = cached_verdict(request)
+    if cached is not None:
+        telemetry.record(Call(request.guild_id, command, request.model), "cached")
+        return cached
+
+    for model in request.models(validate):
+        call = Call(request.guild_id, command, model)
+        try:
+            response = await complete(call, request.tokens, request.messages)
+        except Exception as e:
+            telemetry.record(call, "error")
+            return error_response(e)
+
+        text = response.choices[0].message.content or ""
+        if validate is not None and call.model != settings.gpt.model:
+            if not validate(text):
+                telemetry.record(call, "rejected")
+                logger.warning(f"Rejected response from {call.model}: {text[:100]}")
+                continue
+        telemetry.record(call, "ok")
+        break
+
+    logger.info(f"GPT response: {text}")
+    if not text:
+        return "No response from GPT"
+    # Answers from the resilience fallback model are not cached, so a later
+    # request gets another chance at the routed model.
+    if not call.fallback:
+        verdicts.set(request.key, text)
+    return text
+
+
+async def stream_prompt(
+    ctx: ContextSource,
+    system_prompt: str,
+    command_prompt: str,
+    participants: Optional[list[int]] = None,
+    command: str = "prompt",
+    validate: Optional[Callable[[str], bool]] = None,
+) -> AsyncIterator[str]:
+    """Like send_prompt, but yields the response text accumulated so far as
+    each chunk arrives. With `validate`, a routed model's text is held back
+    until its first line has passed."""
+    request = await prepare_prompt(
+        ctx, system_prompt, command_prompt, participants, command
+    )
+    if request is None:
+        yield NO_CONVERSATION
+        return
+
+    cached = cached_verdict(request)
+    if cached is not None:
+        telemetry.record(Call(request.guild_id, command, request.model), "cached")
+        yield cached
+        return
+
+    for model in request.models(validate):
+        call = Call(request.guild_id, command, model)
+        checked = validate is None or model == settings.gpt.model
+        rejected = False
+        text = ""
+        try:
+            async with aclosing(
+                stream_completion(call, request.tokens, request.messages)
+            ) as deltas:
+                async for delta in deltas:
+                    text += delta
+                    if not checked and "\n" in text:
+                        checked = True
+                        rejected = not validate(text)  # type: ignore
+                        if rejected:
+                            break
+                    if checked:
+                        yield text
+        except Exception as e:
+            telemetry.record(call, "error")
+            yield error_response(e)
+            return
+
+        if not checked:
+            rejected = not validate(text)  # type: ignore
+            if not rejected:
+                yield text
+        if rejected:
+            telemetry.record(call, "rejected")
+            logger.warning(f"Rejected response from {call.model}: {text[:100]}")
+            continue
+        telemetry.record(call, "ok")
+        break
+
+    logger.info(f"GPT response: {text}")
+    if not text:
+        yield "No response from GPT"
+        return
+    if not call.fallback:
+        verdicts.set(request.key, text)
 
 
 if __name__ == "__main__":
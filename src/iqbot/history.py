@@ -0,0 +1,242 @@
+import asyncio
+import sys
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Callable, Optional
+
+from discord import Message
+from discord.abc import Messageable
+from loguru import logger
+
+from iqbot.config import settings
+
+# Rough per-entry cost of the BufferedMessage object and its slots, on top of
+# the formatted string itself.
+ENTRY_OVERHEAD = 200
+
+
+class BufferedMessage:
+    __slots__ = (
+        "id",
+        "author_id",
+        "author_name",
+        "bot",
+        "created_at",
+        "edited_at",
+        "reply_id",
+        "reply_author_id",
+        "formatted",
+        "size",
+    )
+
+    id: int
+    author_id: int
+    author_name: str
+    bot: bool
+    created_at: datetime
+    edited_at: Optional[datetime]
+    reply_id: Optional[int]
+    reply_author_id: Optional[int]
+    formatted: str
+    size: int
+
+    def __init__(self, message: Message, formatted: str) -> None:
+        self.id = message.id
+        self.author_id = message.author.id
+        self.author_name = message.author.name
+        self.bot = message.author.bot
+        self.created_at = message.created_at
+        self.edited_at = message.edited_at
+        self.reply_id = (
+            message.reference.message_id if message.reference is not None else None
+        )
+        self.reply_author_id = (
+            message.reference.resolved.author.id
+            if message.reference is not None
+            and isinstance(message.reference.resolved, Message)
+            else None
+        )
+        self.formatted = formatted
+        self.size = ENTRY_OVERHEAD + sys.getsizeof(formatted)
+
+    def with_text(self, formatted: str) -> "BufferedMessage":
+        """A copy of this entry with different formatted text."""
+        entry = object.__new__(BufferedMessage)
+        for name in self.__slots__:
+            setattr(entry, name, getattr(self, name))
+        entry.formatted = formatted
+        entry.size = ENTRY_OVERHEAD + sys.getsizeof(formatted)
+        return entry
+
+
+class ChannelBuffer:
+    channel_id: int
+    max_messages: int
+    max_bytes: int
+    messages: deque[BufferedMessage]
+    index: dict[int, BufferedMessage]
+    size: int
+    warm: bool
+    lock: asyncio.Lock
+
+    def __init__(self, channel_id: int, max_messages: int, max_bytes: int) -> None:
+        self.channel_id = channel_id
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.messages = deque()
+        self.index = {}
+        self.size = 0
+        self.warm = False
+        self.lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def append(self, entry: BufferedMessage) -> None:
+        if entry.id in self.index:
+            self.replace(entry)
+            return
+        self.messages.append(entry)
+        self.index[entry.id] = entry
+        self.size += entry.size
+        self.trim()
+
+    def replace(self, entry: BufferedMessage) -> None:
+        old = self.index.get(entry.id)
+        if old is None:
+            return
+        self.messages[self.messages.index(old)] = entry
+        self.index[entry.id] = entry
+        self.size += entry.size - old.size
+        self.trim()
+
+    def remove(self, message_id: int) -> None:
+        old = self.index.pop(message_id, None)
+        if old is None:
+            return
+        self.messages.remove(old)
+        self.size -= old.size
+
+    def trim(self) -> None:
+        while self.messages and (
+            len(self.messages) > self.max_messages or self.size > self.max_bytes
+        ):
+            old = self.messages.popleft()
+            del self.index[old.id]
+            self.size -= old.size
+
+    def load(self, entries: list[BufferedMessage]) -> None:
+        """Replace the buffer with `entries` (oldest first), keeping any
+        buffered messages that arrived after the newest loaded one."""
+        newest_id = entries[-1].id if entries else 0
+        newer = [entry for entry in self.messages if entry.id > newest_id]
+        self.messages.clear()
+        self.index.clear()
+        self.size = 0
+        for entry in entries + newer:
+            self.append(entry)
+        self.warm = True
+
+
+class MessageHistory:
+    formatter: Callable[[Message], str]
+    buffers: dict[int, ChannelBuffer]
+
+    def __init__(
+        self,
+        channel_ids: list[int],
+        formatter: Callable[[Message], str],
+        max_messages: int,
+        max_bytes: int,
+    ) -> None:
+        self.formatter = formatter
+        self.buffers = {
+            channel_id: ChannelBuffer(channel_id, max_messages, max_bytes)
+            for channel_id in channel_ids
+        }
+
+    def wrap(self, message: Message) -> BufferedMessage:
+        return BufferedMessage(message, self.formatter(message))
+
+    def add(self, message: Message) -> None:
+        buffer = self.buffers.get(message.channel.id)
+        if buffer is not None:
+            buffer.append(self.wrap(message))
+
+    def edit(self, message: Message) -> None:
+        buffer = self.buffers.get(message.channel.id)
+        if buffer is not None:
+            buffer.replace(self.wrap(message))
+
+    def delete(self, channel_id: int, message_id: int) -> None:
+        buffer = self.buffers.get(channel_id)
+        if buffer is not None:
+            buffer.remove(message_id)
+
+    def invalidate(self) -> None:
+        """Mark every buffer cold, e.g. after a gateway disconnect during which
+        events may have been missed."""
+        for buffer in self.buffers.values():
+            buffer.warm = False
+
+    async def backfill(self, channel: Messageable, buffer: ChannelBuffer) -> None:
+        async with buffer.lock:
+            if buffer.warm:
+                return
+            # Newest first, so that `limit` keeps the newest messages of the
+            # window; paging forward from `after` would keep the oldest.
+            entries = [
+                self.wrap(message)
+                async for message in channel.history(
+                    before=datetime.now(),
+                    after=datetime.now()
+                    - timedelta(minutes=settings.gpt.history.minutes),
+                    limit=buffer.max_messages,
+                    oldest_first=False,
+                )
+            ]
+            entries.reverse()
+            buffer.load(entries)
+            logger.info(
+                f"Backfilled channel {buffer.channel_id}: {len(buffer)} messages, {buffer.size} bytes"
+            )
+
+    async def read(
+        self, channel: Messageable, limit: Optional[int] = None
+    ) -> AsyncIterator[BufferedMessage]:
+        """Yield up to `limit` (by default `gpt.history.messages`) of the
+        channel's recent messages, newest first, from the buffer when the
+        channel is tracked and over REST otherwise."""
+        limit = limit or settings.gpt.history.messages
+        after = datetime.now() - timedelta(minutes=settings.gpt.history.minutes)
+        buffer = self.buffers.get(getattr(channel, "id", 0))
+
+        if buffer is None:
+            async for message in channel.history(
+                before=datetime.now(),
+                after=after,
+                limit=limit,
+                oldest_first=False,
+            ):
+                yield self.wrap(message)
+            return
+
+        if not buffer.warm:
+            await self.backfill(channel, buffer)
+
+        after = after.astimezone(timezone.utc)
+        for i, entry in enumerate(reversed(list(buffer.messages))):
+            if i >= limit or entry.created_at <= after:
+                break
+            yield entry
+
+    def stats(self) -> dict[int, dict[str, int | bool]]:
+        return {
+            channel_id: {
+                "messages": len(buffer),
+                "bytes": buffer.size,
+                "max_bytes": buffer.max_bytes,
+                "warm": buffer.warm,
+            }
+            for channel_id, buffer in self.buffers.items()
+        }
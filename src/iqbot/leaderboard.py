@@ -0,0 +1,59 @@
+from bisect import bisect_left, insort
+from typing import Iterable, Optional
+
+
+class Leaderboard:
+    """A guild's present users ordered by IQ, highest first and ties broken
+    by user id. Ranks start at 1 and are found by bisection."""
+
+    iqs: dict[int, int]
+    order: list[tuple[int, int]]
+
+    def __init__(self, users: Iterable[tuple[int, int]] = ()) -> None:
+        self.iqs = dict(users)
+        self.order = sorted((-iq, user_id) for user_id, iq in self.iqs.items())
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.iqs
+
+    def update(self, user_id: int, iq: Optional[int]) -> None:
+        """Move the user to `iq`, or take them off the board if it is None."""
+        old = self.iqs.pop(user_id, None)
+        if old is not None:
+            del self.order[bisect_left(self.order, (-old, user_id))]
+        if iq is not None:
+            self.iqs[user_id] = iq
+            insort(self.order, (-iq, user_id))
+
+    def rank(self, user_id: int) -> Optional[int]:
+        iq = self.iqs.get(user_id)
+        if iq is None:
+            return None
+        return bisect_left(self.order, (-iq, user_id)) + 1
+
+    def top(self, n: int, offset: int = 0) -> list[tuple[int, int]]:
+        """`(user_id, iq)` of the `n` highest users after the first `offset`."""
+        return [(user_id, -iq) for iq, user_id in self.order[offset : offset + n]]
+
+    def bottom(self, n: int, offset: int = 0) -> list[tuple[int, int]]:
+        """`(user_id, iq)` of the `n` lowest users after the last `offset`,
+        lowest first."""
+        end = len(self.order) - offset
+        if end <= 0:
+            return []
+        start = max(end - n, 0)
+        return [(user_id, -iq) for iq, user_id in reversed(self.order[start:end])]
+
+    def around(self, user_id: int, n: int) -> list[tuple[int, int, int]]:
+        """`(rank, user_id, iq)` of the user and up to `n` users either side."""
+        rank = self.rank(user_id)
+        if rank is None:
+            return []
+        start = max(rank - 1 - n, 0)
+        return [
+            (start + i + 1, other_id, -iq)
+            for i, (iq, other_id) in enumerate(self.order[start : rank + n])
+        ]
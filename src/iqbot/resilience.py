@@ -0,0 +1,121 @@
+import asyncio
+import random
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from loguru import logger
+from openai import APIConnectionError, InternalServerError, RateLimitError
+
+from iqbot.config import settings
+
+T = TypeVar("T")
+
+# APITimeoutError is an APIConnectionError; asyncio.TimeoutError is raised
+# when an attempt runs past gpt.retry.deadline.
+RETRYABLE = (
+    APIConnectionError,
+    InternalServerError,
+    RateLimitError,
+    asyncio.TimeoutError,
+)
+
+
+def retryable(error: BaseException) -> bool:
+    return isinstance(error, RETRYABLE)
+
+
+def backoff(attempt: int) -> float:
+    """Exponential backoff with full jitter, so callers that failed together
+    do not retry together."""
+    ceiling = min(
+        settings.gpt.retry.backoff_max, settings.gpt.retry.backoff_base * 2**attempt
+    )
+    return random.uniform(0, ceiling)
+
+
+async def deadline(attempt: Awaitable[T]) -> T:
+    return await asyncio.wait_for(attempt, settings.gpt.retry.deadline)
+
+
+async def hedge(
+    attempt: Callable[[bool], Awaitable[T]],
+    delay: Optional[float],
+    on_hedge: Callable[[], None],
+    discard: Optional[Callable[[T], Awaitable[None]]] = None,
+) -> T:
+    """Run `attempt(False)`; if it has not finished after `delay` seconds,
+    also run `attempt(True)`. The first to succeed wins and the other is
+    cancelled; an error is only raised once both have failed. `discard`
+    releases the result of an attempt that finished but lost."""
+    pending = {asyncio.create_task(attempt(False))}
+    error: Optional[BaseException] = None
+    try:
+        if delay is not None:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if not done:
+                on_hedge()
+                pending.add(asyncio.create_task(attempt(True)))
+
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            winners = [
+                task for task in done if not task.cancelled() and not task.exception()
+            ]
+            if winners:
+                for task in winners[1:]:
+                    if discard is not None:
+                        await discard(task.result())
+                return winners[0].result()
+            task = done.pop()
+            error = asyncio.CancelledError() if task.cancelled() else task.exception()
+        assert error is not None
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+        for result in await asyncio.gather(*pending, return_exceptions=True):
+            if discard is not None and not isinstance(result, BaseException):
+                await discard(result)
+
+
+async def retrying(
+    models: list[str],
+    attempt: Callable[[str, bool], Awaitable[T]],
+    hedge_delay: Callable[[str], Optional[float]],
+    on_retry: Callable[[BaseException, int], Optional[float]],
+    on_hedge: Callable[[], None],
+    on_fallback: Callable[[str], None],
+    discard: Optional[Callable[[T], Awaitable[None]]] = None,
+) -> T:
+    """Call `attempt(model, hedged)` up to `gpt.retry.attempts` times per
+    model, moving down `models` once a model's attempts are used up. Only
+    retryable errors are retried. `on_retry` may return how long to wait
+    before the next attempt, otherwise a jittered backoff is used."""
+    error: Optional[BaseException] = None
+    for model in models:
+        if error is not None:
+            logger.warning(f"Falling back to {model} after: {error}")
+            on_fallback(model)
+        for n in range(settings.gpt.retry.attempts):
+            try:
+                return await hedge(
+                    lambda hedged: attempt(model, hedged),
+                    hedge_delay(model),
+                    on_hedge,
+                    discard,
+                )
+            except Exception as e:
+                if not retryable(e):
+                    raise
+                error = e
+            if n + 1 < settings.gpt.retry.attempts:
+                wait = on_retry(error, n)
+                wait = backoff(n) if wait is None else wait
+                logger.warning(
+                    f"GPT attempt {n + 1} on {model} failed ({type(error).__name__}: "
+                    f"{error}), retrying in {wait:.1f}s"
+                )
+                await asyncio.sleep(wait)
+    assert error is not None
+    raise error
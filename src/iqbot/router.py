@@ -0,0 +1,36 @@
+from loguru import logger
+
+from iqbot.config import settings
+from iqbot.telemetry import Telemetry
+
+
+def choose_model(command: str, tokens: int, telemetry: Telemetry) -> str:
+    """Pick the model for a request from `gpt.router.routes`: the first route
+    that covers `command`, fits `tokens` and whose recent p95 latency is
+    within its limit. Anything else goes to `gpt.model`."""
+    router = settings.gpt.router
+    if not router.enabled:
+        return settings.gpt.model
+
+    for route in router.routes:
+        if route.commands and command not in route.commands:
+            continue
+        if tokens > route.max_tokens:
+            continue
+        latency = telemetry.percentile(route.model, "latency", 95, router.min_samples)
+        if latency is not None and latency > route.max_latency:
+            logger.info(
+                f"Skipping {route.model} for {command}: p95 latency {latency:.1f}s "
+                f"over {route.max_latency:.1f}s"
+            )
+            continue
+        logger.info(f"Routing {command} ({tokens} tokens) to {route.model}")
+        return route.model
+    return settings.gpt.model
+
+
+def model_chain(model: str) -> list[str]:
+    """Models to try for a request routed to `model`, in order: the routed
+    model, the primary model, then the fallback model."""
+    chain = [model, settings.gpt.model, settings.gpt.retry.fallback_model]
+    return list(dict.fromkeys(m for m in chain if m))
@@ -0,0 +1,182 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from time import monotonic
+from typing import AsyncIterator, Optional
+
+from loguru import logger
+
+
+class TokenBucket:
+    capacity: float
+    rate: float
+    level: float
+    updated: float
+
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = monotonic()
+
+    def refill(self) -> None:
+        now = monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float) -> float:
+        """Seconds until `amount` can be taken from the bucket."""
+        self.refill()
+        amount = min(amount, self.capacity)
+        return max(amount - self.level, 0) / self.rate
+
+    def take(self, amount: float) -> None:
+        self.refill()
+        self.level -= min(amount, self.capacity)
+
+
+class Ticket:
+    guild_id: int
+    tokens: int
+    enqueued: float
+    wait: float
+    depth: int
+    granted: asyncio.Future
+
+    def __init__(self, guild_id: int, tokens: int, depth: int) -> None:
+        self.guild_id = guild_id
+        self.tokens = tokens
+        self.enqueued = monotonic()
+        self.wait = 0.0
+        self.depth = depth
+        self.granted = asyncio.get_running_loop().create_future()
+
+
+class Scheduler:
+    """Admits GPT requests under requests-per-minute, tokens-per-minute and
+    concurrency limits, serving guilds round-robin so one busy guild cannot
+    starve the rest."""
+
+    requests: TokenBucket
+    tokens: TokenBucket
+    concurrency: int
+    active: int
+    queues: dict[int, deque[Ticket]]
+    order: deque[int]
+    paused_until: float
+    wakeup: asyncio.Event
+    task: Optional[asyncio.Task]
+    waits: deque[float]
+
+    def __init__(self, rpm: int, tpm: int, concurrency: int) -> None:
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.concurrency = concurrency
+        self.active = 0
+        self.queues = {}
+        self.order = deque()
+        self.paused_until = 0.0
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.waits = deque(maxlen=100)
+
+    def depth(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def backoff(self, seconds: float) -> None:
+        """Stop admitting requests for `seconds`, e.g. on a provider 429."""
+        self.paused_until = max(self.paused_until, monotonic() + seconds)
+        logger.warning(f"GPT scheduler backing off for {seconds:.1f} seconds")
+
+    @asynccontextmanager
+    async def slot(self, guild_id: int, tokens: int) -> AsyncIterator[Ticket]:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.dispatch())
+
+        ticket = Ticket(guild_id, tokens, self.depth())
+        if guild_id not in self.queues:
+            self.queues[guild_id] = deque()
+            self.order.append(guild_id)
+        self.queues[guild_id].append(ticket)
+        self.wakeup.set()
+
+        try:
+            await ticket.granted
+        except asyncio.CancelledError:
+            self.discard(ticket)
+            raise
+
+        ticket.wait = monotonic() - ticket.enqueued
+        self.waits.append(ticket.wait)
+        logger.info(
+            f"GPT request for guild {guild_id} admitted after {ticket.wait:.2f}s "
+            f"(queue depth {ticket.depth}, {tokens} tokens)"
+        )
+        try:
+            yield ticket
+        finally:
+            self.active -= 1
+            self.wakeup.set()
+
+    def discard(self, ticket: Ticket) -> None:
+        if ticket.granted.done() and not ticket.granted.cancelled():
+            self.active -= 1
+            self.wakeup.set()
+            return
+        queue = self.queues.get(ticket.guild_id)
+        if queue is not None and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del self.queues[ticket.guild_id]
+                self.order.remove(ticket.guild_id)
+
+    def next_delay(self) -> Optional[float]:
+        if not self.order or self.active >= self.concurrency:
+            return None
+        ticket = self.queues[self.order[0]][0]
+        return max(
+            self.paused_until - monotonic(),
+            self.requests.delay(1),
+            self.tokens.delay(ticket.tokens),
+            0,
+        )
+
+    def grant(self) -> None:
+        guild_id = self.order.popleft()
+        queue = self.queues[guild_id]
+        ticket = queue.popleft()
+        if queue:
+            self.order.append(guild_id)
+        else:
+            del self.queues[guild_id]
+        if ticket.granted.cancelled():
+            return
+
+        self.requests.take(1)
+        self.tokens.take(ticket.tokens)
+        self.active += 1
+        ticket.granted.set_result(None)
+
+    async def dispatch(self) -> None:
+        while True:
+            self.wakeup.clear()
+            delay = self.next_delay()
+            if delay is None:
+                await self.wakeup.wait()
+            elif delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                self.grant()
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            "queued": self.depth(),
+            "active": self.active,
+            "guilds": len(self.order),
+            "avg_wait": sum(self.waits) / len(self.waits) if self.waits else 0.0,
+            "max_wait": max(self.waits, default=0.0),
+            "paused_for": max(self.paused_until - monotonic(), 0.0),
+        }
@@ -0,0 +1,46 @@
+from time import perf_counter
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional
+
+from loguru import logger
+
+from iqbot.config import settings
+
+
+async def stream_reply(
+    chunks: AsyncIterator[str],
+    send: Callable[[str], Awaitable[Any]],
+    transform: Callable[[str], str] = lambda text: text,
+    on_text: Optional[Callable[[str], None]] = None,
+) -> str:
+    """Post the first visible text from `chunks` with `send`, then edit that
+    message as more text arrives, at most once per `gpt.stream.edit_interval`
+    seconds. `chunks` yields the full text so far; `on_text` sees every
+    update. Returns the final untransformed text."""
+    start = perf_counter()
+    message = None
+    shown = ""
+    last_edit = 0.0
+    text = ""
+
+    async for text in chunks:
+        if on_text is not None:
+            on_text(text)
+        visible = transform(text)[0:1999]
+        if not visible.strip():
+            continue
+
+        if message is None:
+            message = await send(visible)
+            logger.info(f"Time to first visible output: {perf_counter() - start:.2f}s")
+        elif perf_counter() - last_edit >= settings.gpt.stream.edit_interval:
+            await message.edit(content=visible)
+        else:
+            continue
+        shown = visible
+        last_edit = perf_counter()
+
+    final = transform(text)[0:1999]
+    if message is not None and final != shown:
+        await message.edit(content=final)
+    logger.info(f"Streamed response completed in {perf_counter() - start:.2f}s")
+    return text
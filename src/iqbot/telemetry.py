@@ -0,0 +1,266 @@
+import statistics
+from collections import deque
+from time import perf_counter, time
+from typing import Any, Optional
+
+from loguru import logger
+from openai.types import CompletionUsage
+
+from iqbot.config import settings
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 64.0, float("inf"))
+
+
+def percentile(values: list[float], q: int) -> float:
+    """The `q`th percentile of `values`, interpolated between them and never
+    outside their range."""
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+def cost(
+    model: str, prompt_tokens: int, cached_tokens: int, completion_tokens: int
+) -> tuple[float, float]:
+    """Dollar cost of a call at the per-million-token prices in
+    `gpt.telemetry.prices`, and how much the cached prompt tokens saved;
+    0 for models without a price."""
+    price = settings.gpt.telemetry.prices.get(model)
+    if price is None:
+        return 0.0, 0.0
+    total = (
+        (prompt_tokens - cached_tokens) * price.input
+        + cached_tokens * price.cached_input
+        + completion_tokens * price.output
+    )
+    saved = cached_tokens * (price.input - price.cached_input)
+    return total / 1_000_000, saved / 1_000_000
+
+
+class Call:
+    """Timers and token usage for one model call, including its retries."""
+
+    __slots__ = (
+        "timestamp",
+        "guild_id",
+        "command",
+        "model",
+        "status",
+        "wait",
+        "latency",
+        "ttfb",
+        "retries",
+        "hedges",
+        "fallback",
+        "prompt_tokens",
+        "completion_tokens",
+        "cached_tokens",
+        "cost",
+        "saved",
+        "created",
+        "queued",
+        "started",
+    )
+
+    timestamp: float
+    guild_id: int
+    command: str
+    model: str
+    status: str
+    wait: float
+    latency: float
+    ttfb: Optional[float]
+    retries: int
+    hedges: int
+    fallback: bool
+    prompt_tokens: int
+    completion_tokens: int
+    cached_tokens: int
+    cost: float
+    saved: float
+    created: float
+    queued: float
+    started: Optional[float]
+
+    def __init__(self, guild_id: int, command: str, model: str) -> None:
+        self.timestamp = time()
+        self.guild_id = guild_id
+        self.command = command
+        self.model = model
+        self.status = "pending"
+        self.wait = 0.0
+        self.latency = 0.0
+        self.ttfb = None
+        self.retries = 0
+        self.hedges = 0
+        self.fallback = False
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.cost = 0.0
+        self.saved = 0.0
+        self.created = perf_counter()
+        self.queued = self.created
+        self.started = None
+
+    def begin(self) -> None:
+        """Mark the start of an attempt, once the scheduler grants a slot."""
+        now = perf_counter()
+        self.wait += now - self.queued
+        self.started = now
+
+    def first_byte(self) -> None:
+        if self.ttfb is None and self.started is not None:
+            self.ttfb = perf_counter() - self.started
+
+    def retry(self) -> None:
+        """Mark a failed attempt; the call goes back to waiting for a slot."""
+        self.retries += 1
+        self.queued = perf_counter()
+
+    def hedge(self) -> None:
+        self.hedges += 1
+
+    def fall_back(self, model: str) -> None:
+        """Switch to the fallback model; like a retry, the call waits for a
+        slot again."""
+        self.model = model
+        self.fallback = True
+        self.queued = perf_counter()
+
+    def usage(self, usage: Optional[CompletionUsage]) -> None:
+        if usage is None:
+            return
+        details = usage.prompt_tokens_details
+        self.prompt_tokens = usage.prompt_tokens
+        self.completion_tokens = usage.completion_tokens
+        self.cached_tokens = (details.cached_tokens or 0) if details else 0
+        self.cost, self.saved = cost(
+            self.model, self.prompt_tokens, self.cached_tokens, self.completion_tokens
+        )
+
+    def finish(self, status: str) -> None:
+        self.status = status
+        if self.started is not None:
+            self.latency = perf_counter() - self.created - self.wait
+            if self.ttfb is None:
+                self.ttfb = self.latency
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            name: getattr(self, name)
+            for name in self.__slots__
+            if name not in ("created", "queued", "started")
+        }
+
+
+def summarize(calls: list[Call]) -> dict[str, Any]:
+    completed = [call for call in calls if call.started is not None]
+    latencies = sorted(call.latency for call in completed)
+    ttfbs = sorted(call.ttfb for call in completed if call.ttfb is not None)
+    # Time to first byte is where provider-side prompt caching shows up.
+    ttfbs_hit = sorted(
+        call.ttfb for call in completed if call.ttfb is not None and call.cached_tokens
+    )
+    ttfbs_miss = sorted(
+        call.ttfb
+        for call in completed
+        if call.ttfb is not None and not call.cached_tokens
+    )
+    histogram = [0] * len(LATENCY_BUCKETS)
+    for latency in latencies:
+        histogram[next(i for i, b in enumerate(LATENCY_BUCKETS) if latency <= b)] += 1
+
+    return {
+        "calls": len(calls),
+        "errors": sum(call.status == "error" for call in calls),
+        "cached": sum(call.status == "cached" for call in calls),
+        "rejected": sum(call.status == "rejected" for call in calls),
+        "retries": sum(call.retries for call in calls),
+        "hedges": sum(call.hedges for call in calls),
+        "fallbacks": sum(call.fallback for call in calls),
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "ttfb_p50": percentile(ttfbs, 50),
+        "ttfb_p95": percentile(ttfbs, 95),
+        "ttfb_p50_prefix_hit": percentile(ttfbs_hit, 50),
+        "ttfb_p50_prefix_miss": percentile(ttfbs_miss, 50),
+        "wait_p95": percentile(sorted(call.wait for call in completed), 95),
+        "prompt_tokens": sum(call.prompt_tokens for call in calls),
+        "completion_tokens": sum(call.completion_tokens for call in calls),
+        "cached_tokens": sum(call.cached_tokens for call in calls),
+        "cost": sum(call.cost for call in calls),
+        "saved": sum(call.saved for call in calls),
+        "latency_histogram": {
+            str(bound): count for bound, count in zip(LATENCY_BUCKETS, histogram)
+        },
+    }
+
+
+class Telemetry:
+    """Rolling record of the model calls made in the last `window` seconds,
+    capped at `size` calls, aggregated on demand per guild and per command."""
+
+    window: float
+    size: int
+    calls: deque[Call]
+
+    def __init__(self, window: float, size: int) -> None:
+        self.window = window
+        self.size = size
+        self.calls = deque(maxlen=size)
+
+    def record(self, call: Call, status: str) -> None:
+        call.finish(status)
+        self.calls.append(call)
+        logger.info(
+            f"GPT call {call.command} guild={call.guild_id} model={call.model} "
+            f"status={status} wait={call.wait:.2f}s latency={call.latency:.2f}s "
+            f"ttfb={call.ttfb or 0:.2f}s retries={call.retries} hedges={call.hedges} "
+            f"tokens={call.prompt_tokens}+{call.completion_tokens} "
+            f"(cached {call.cached_tokens}) cost=${call.cost:.5f}"
+        )
+
+    def recent(self) -> list[Call]:
+        cutoff = time() - self.window
+        while self.calls and self.calls[0].timestamp < cutoff:
+            self.calls.popleft()
+        return list(self.calls)
+
+    def group(self, field: str) -> dict[Any, dict[str, Any]]:
+        groups: dict[Any, list[Call]] = {}
+        for call in self.recent():
+            groups.setdefault(getattr(call, field), []).append(call)
+        return {key: summarize(calls) for key, calls in groups.items()}
+
+    def percentile(
+        self, model: str, field: str, q: int, min_samples: int
+    ) -> Optional[float]:
+        """The `q`th percentile of `field` over the model's recent successful
+        calls, or None with fewer than `min_samples` of them."""
+        values = [
+            getattr(call, field)
+            for call in self.recent()
+            if call.model == model
+            and call.status == "ok"
+            and getattr(call, field) is not None
+        ]
+        if len(values) < max(min_samples, 2):
+            return None
+        return percentile(values, q)
+
+    def total(self) -> dict[str, Any]:
+        return summarize(self.recent())
+
+    def export(self) -> dict[str, Any]:
+        calls = self.recent()
+        return {
+            "window": self.window,
+            "exported_at": time(),
+            "total": summarize(calls),
+            "guilds": {str(k): v for k, v in self.group("guild_id").items()},
+            "commands": self.group("command"),
+            "models": self.group("model"),
+            "calls": [call.to_dict() for call in calls],
+        }
@@ -0,0 +1,76 @@
+from collections import OrderedDict
+from datetime import datetime
+from functools import lru_cache
+from typing import Optional
+
+import tiktoken
+from discord import Message
+from loguru import logger
+
+from iqbot.config import settings
+
+FALLBACK_ENCODING = "o200k_base"
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        logger.warning(f"No tokenizer known for {model}, using {FALLBACK_ENCODING}")
+        return tiktoken.get_encoding(FALLBACK_ENCODING)
+
+
+class TokenCounter:
+    model: str
+    encoding: tiktoken.Encoding
+    cache_size: int
+    message_counts: OrderedDict[tuple[int, Optional[datetime], int], int]
+    fixed_costs: dict[tuple[str, str], int]
+
+    def __init__(self, model: str, cache_size: int) -> None:
+        self.model = model
+        self.encoding = get_encoding(model)
+        self.cache_size = cache_size
+        self.message_counts = OrderedDict()
+        self.fixed_costs = {}
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        return len(self.encoding.encode(text))
+
+    def count_message(self, message: Message, formatted: str) -> int:
+        # The length tells apart different renderings of the same message,
+        # e.g. before and after compaction.
+        key = (message.id, message.edited_at, len(formatted))
+        tokens = self.message_counts.get(key)
+        if tokens is not None:
+            self.message_counts.move_to_end(key)
+            return tokens
+
+        tokens = self.count(formatted)
+        self.message_counts[key] = tokens
+        if len(self.message_counts) > self.cache_size:
+            self.message_counts.popitem(last=False)
+        return tokens
+
+    def fixed_cost(self, system_prompt: str, template: str) -> int:
+        key = (system_prompt, template)
+        if key not in self.fixed_costs:
+            self.fixed_costs[key] = (
+                settings.gpt.tokens.overhead_max
+                + settings.gpt.tokens.prompt_max
+                + settings.gpt.tokens.output_max
+                + self.count(system_prompt.strip())
+                + self.count(template)
+            )
+        return self.fixed_costs[key]
+
+    def budget(self, system_prompt: str, template: str) -> int:
+        return settings.gpt.tokens.limit - self.fixed_cost(system_prompt, template)
+
+
+@lru_cache(maxsize=None)
+def get_counter(model: str) -> TokenCounter:
+    return TokenCounter(model, settings.gpt.tokens.cache_size)
@@ -0,0 +1,33 @@
+import os
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+os.environ.setdefault("TOKENS", '{"bot": "offline", "gpt": "offline"}')
+
+import pytest
+from bench_context import FakeChannel, FakeMessage, WordEncoding
+from discord import Message, utils
+
+from iqbot import tokens
+from iqbot.tokens import TokenCounter
+
+
+def post(channel: FakeChannel, author_id: int, content: str) -> FakeMessage:
+    """Add a message to the channel's history, a minute old and after every
+    message posted before it."""
+    created = datetime.now(timezone.utc) - timedelta(minutes=1)
+    message_id = utils.time_snowflake(created) + len(channel.messages)
+    author = SimpleNamespace(id=author_id, name=f"user{author_id}", bot=False)
+    message = FakeMessage(message_id, author, content, channel)
+    channel.messages.append(message)
+    return message
+
+
+def format_message(message: Message) -> str:
+    return f"[ID: {message.id} | {message.author.name}]: {message.content}"
+
+
+@pytest.fixture
+def counter(monkeypatch) -> TokenCounter:
+    monkeypatch.setattr(tokens, "get_encoding", lambda model: WordEncoding())
+    return TokenCounter("gpt-4o", 1000)
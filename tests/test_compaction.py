@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+from bench_context import FakeChannel
+
+from iqbot import compaction
+from iqbot.context import ContextBuilder
+from iqbot.history import MessageHistory
+
+from .conftest import format_message, post
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "It costs $1000000 a year",
+        "population 100000",
+        "id 123123123123",
+        "pi is 3.1111111",
+    ],
+)
+def test_compact_keeps_numbers(counter, text):
+    assert compaction.compact(text, counter, 300) == text
+
+
+def test_compact_collapses_repeated_text(counter):
+    assert compaction.compact("hahahahahaha!!!!!!", counter, 300) == "hahaha!!!"
+
+
+def test_near_duplicate_requires_same_numbers():
+    assert not compaction.near_duplicate("67 million people", "68 million people", 0.9)
+    assert not compaction.near_duplicate("bystander 3", "bystander 4", 0.9)
+    assert compaction.near_duplicate("67 million people!", "67 million people", 0.9)
+
+
+async def build(channel: FakeChannel, counter) -> list[str]:
+    history = MessageHistory([], format_message, 100, 2**20)
+    builder = ContextBuilder(history, counter, 10_000)
+    conversation = await builder.build(channel)
+    return [compaction.split(line)[1] for line in conversation.text.splitlines()]
+
+
+def test_corrections_are_not_collapsed(counter):
+    channel = FakeChannel(1, [])
+    post(channel, 1, "there are 67 million people in France")
+    post(channel, 1, "there are 68 million people in France")
+    post(channel, 1, "there are 68 million people in France!")
+
+    assert asyncio.run(build(channel, counter)) == [
+        "there are 67 million people in France",
+        "there are 68 million people in France! [sent 2 times]",
+    ]
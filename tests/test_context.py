@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+from bench_context import FakeChannel
+
+from iqbot.config import settings
+from iqbot.context import ContextBuilder, next_anchor
+from iqbot.history import MessageHistory
+
+from .conftest import format_message, post
+
+
+def build(history: MessageHistory, channel: FakeChannel, counter, anchor: int = 0):
+    builder = ContextBuilder(history, counter, 10_000, anchor=anchor)
+    return asyncio.run(builder.build(channel))
+
+
+@pytest.mark.parametrize("tracked", [False, True])
+def test_anchor_fixes_the_first_message(monkeypatch, counter, tracked):
+    monkeypatch.setattr(settings.gpt.history, "messages", 10)
+    monkeypatch.setattr(settings.gpt.prompt, "anchor_slack", 5)
+    channel = FakeChannel(1, [])
+    history = MessageHistory(
+        [channel.id] if tracked else [], format_message, 100, 2**20
+    )
+
+    def post_more(count: int) -> None:
+        for _ in range(count):
+            history.add(post(channel, 2, f"message {len(channel.messages)}"))
+
+    post_more(10)
+    first = build(history, channel, counter)
+    assert first.messages[0].id == channel.messages[0].id
+    anchor = next_anchor(first)
+
+    post_more(3)
+    anchored = build(history, channel, counter, anchor=anchor)
+    assert anchored.messages[0].id == channel.messages[0].id
+    assert anchored.messages[-1].id == channel.messages[-1].id
+    assert next_anchor(anchored) == anchor
+
+    # Without an anchor the window slides.
+    sliding = build(history, channel, counter)
+    assert sliding.messages[0].id == channel.messages[3].id
+
+    # The anchored window stops growing at gpt.history.messages plus the
+    # slack, and the next anchor starts a window of the usual size.
+    post_more(3)
+    full = build(history, channel, counter, anchor=anchor)
+    assert len(full.messages) == 15
+    anchor = next_anchor(full)
+    assert anchor == channel.messages[-10].id
+
+    post_more(1)
+    anchored = build(history, channel, counter, anchor=anchor)
+    assert anchored.messages[0].id == anchor
+    assert len(anchored.messages) == 11
+
+
+def test_anchor_does_not_reach_past_the_budget(monkeypatch, counter):
+    monkeypatch.setattr(settings.gpt.history, "messages", 10)
+    channel = FakeChannel(1, [])
+    for i in range(20):
+        post(channel, 1, f"message {i}")
+    history = MessageHistory([], format_message, 100, 2**20)
+    # Each formatted message is six words, so the budget fits four.
+    builder = ContextBuilder(history, counter, 24, anchor=channel.messages[0].id)
+    conversation = asyncio.run(builder.build(channel))
+    assert conversation.truncated
+    assert [m.id for m in conversation.messages] == [
+        m.id for m in channel.messages[-4:]
+    ]
+
+
+def test_older_messages_overflow_past_the_message_cap(monkeypatch, counter):
+    monkeypatch.setattr(settings.gpt.history, "messages", 10)
+    channel = FakeChannel(1, [])
+    for i in range(25):
+        post(channel, 1, f"message {i}")
+    history = MessageHistory([channel.id], format_message, 100, 2**20)
+    builder = ContextBuilder(history, counter, 10_000, overflow_budget=60)
+    conversation = asyncio.run(builder.build(channel))
+    assert [m.id for m in conversation.messages] == [
+        m.id for m in channel.messages[-10:]
+    ]
+    # The overflow budget fits ten of the fifteen older messages.
+    assert [m.id for m in conversation.overflow] == [
+        m.id for m in channel.messages[5:15]
+    ]
+
+
+def test_messages_older_than_the_anchor_overflow(counter):
+    channel = FakeChannel(1, [])
+    for i in range(10):
+        post(channel, 1, f"message {i}")
+    history = MessageHistory([], format_message, 100, 2**20)
+    builder = ContextBuilder(
+        history, counter, 10_000, anchor=channel.messages[4].id, overflow_budget=1000
+    )
+    conversation = asyncio.run(builder.build(channel))
+    assert conversation.messages[0].id == channel.messages[4].id
+    assert [m.id for m in conversation.overflow] == [m.id for m in channel.messages[:4]]
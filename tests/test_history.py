@@ -0,0 +1,36 @@
+import asyncio
+
+from bench_context import FakeChannel
+
+from iqbot.history import MessageHistory
+
+from .conftest import format_message, post
+
+
+async def read_all(history: MessageHistory, channel: FakeChannel) -> list[int]:
+    return [message.id async for message in history.read(channel, 100)]
+
+
+def test_backfill_keeps_the_newest_messages():
+    channel = FakeChannel(1, [])
+    for i in range(12):
+        post(channel, 1, f"message {i}")
+    history = MessageHistory([channel.id], format_message, 5, 2**20)
+    assert asyncio.run(read_all(history, channel)) == [
+        m.id for m in reversed(channel.messages[-5:])
+    ]
+
+
+def test_backfill_after_invalidate_keeps_new_messages():
+    channel = FakeChannel(1, [])
+    history = MessageHistory([channel.id], format_message, 5, 2**20)
+    for i in range(3):
+        post(channel, 1, f"message {i}")
+    asyncio.run(read_all(history, channel))
+
+    history.invalidate()
+    for i in range(3, 10):
+        post(channel, 1, f"message {i}")
+    assert asyncio.run(read_all(history, channel)) == [
+        m.id for m in reversed(channel.messages[-5:])
+    ]
@@ -0,0 +1,13 @@
+from iqbot.telemetry import percentile
+
+
+def test_percentile_stays_within_the_data():
+    values = [1.0, 1.1, 1.2, 1.3, 2.0]
+    assert percentile(values, 95) <= 2.0
+    assert percentile(values, 99) <= 2.0
+    assert percentile(values, 50) == 1.2
+
+
+def test_percentile_of_few_values():
+    assert percentile([], 95) == 0.0
+    assert percentile([3.0], 95) == 3.0